@@ -0,0 +1,123 @@
+"""
+Restricted unpickling of the pickles embedded in uploaded replays
+
+The battle results, battle level and roster blobs are plain containers of
+numbers and strings, so only the globals listed in SAFE_GLOBALS are
+resolved. Loading is done by cPickle, which is many times faster than the
+pure Python unpickler and builds nested containers without recursing. The
+limits are enforced around it: a pickle may not read more than max_bytes of
+input, which is checked before or while cPickle reads it, and the loaded
+object may not hold a container of more than max_items entries or nest
+deeper than max_depth, which is checked before it is returned. Breaking any
+of them raises an UnsafePickleError.
+"""
+
+import pickle
+import cPickle
+from cStringIO import StringIO
+
+# (module, name) pairs a pickle may refer to
+SAFE_GLOBALS = frozenset([
+    ('__builtin__', 'set'),
+    ('__builtin__', 'frozenset'),
+])
+
+MAX_BYTES = 4 * 1024 * 1024
+MAX_ITEMS = 100000
+MAX_DEPTH = 32
+
+CONTAINER_TYPES = frozenset([dict, list, tuple, set, frozenset])
+
+
+class UnsafePickleError(cPickle.UnpicklingError, pickle.UnpicklingError):
+    pass
+
+
+def find_global(module, name):
+    if (module, name) not in SAFE_GLOBALS:
+        raise UnsafePickleError("Global {}.{} is not allowed".format(module, name))
+    return getattr(__import__(module), name)
+
+
+class LimitedReader(object):
+    """
+    File object f for cPickle, refusing to read past max_bytes
+    """
+
+    def __init__(self, f, max_bytes):
+        self._read = f.read
+        self._readline = f.readline
+        self.remaining = max_bytes
+
+    def read(self, n):
+        if n > self.remaining:
+            raise UnsafePickleError("Pickle is larger than allowed")
+        data = self._read(n)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self):
+        data = self._readline(self.remaining + 1)
+        if len(data) > self.remaining:
+            raise UnsafePickleError("Pickle is larger than allowed")
+        self.remaining -= len(data)
+        return data
+
+
+def check_limits(obj, max_items=MAX_ITEMS, max_depth=MAX_DEPTH):
+    """
+    Raises an UnsafePickleError if a container in obj has more than max_items entries or containers
+    nest deeper than max_depth. Walks obj without recursing, and every container once.
+    """
+    todo = [(obj, 1)]
+    seen = set()
+    while todo:
+        container, depth = todo.pop()
+        if id(container) in seen:
+            continue
+        seen.add(id(container))
+        if depth > max_depth:
+            raise UnsafePickleError("Pickle is nested deeper than allowed")
+        if len(container) > max_items:
+            raise UnsafePickleError("Pickle container is larger than allowed")
+
+        if type(container) is dict:
+            children = container.keys() + container.values()
+        else:
+            children = container
+        todo.extend((c, depth + 1) for c in children if type(c) in CONTAINER_TYPES)
+
+
+def _load(f, max_items, max_depth):
+    unpickler = cPickle.Unpickler(f)
+    unpickler.find_global = find_global
+    obj = unpickler.load()
+    if type(obj) in CONTAINER_TYPES:
+        check_limits(obj, max_items, max_depth)
+    return obj
+
+
+def load(f, max_bytes=MAX_BYTES, max_items=MAX_ITEMS, max_depth=MAX_DEPTH):
+    """
+    Unpickles one object from file object f within the limits. Any failure is raised as an UnpicklingError.
+    """
+    try:
+        return _load(LimitedReader(f, max_bytes), max_items, max_depth)
+    except UnsafePickleError:
+        raise
+    except Exception as e:
+        raise UnsafePickleError("Could not unpickle data: {!r}".format(e))
+
+
+def loads(data, max_bytes=MAX_BYTES, max_items=MAX_ITEMS, max_depth=MAX_DEPTH):
+    """
+    Unpickles data, which may not be longer than max_bytes, within the limits
+    """
+    if len(data) > max_bytes:
+        raise UnsafePickleError("Pickle is larger than allowed")
+    try:
+        return _load(StringIO(data), max_items, max_depth)
+    except UnsafePickleError:
+        raise
+    except Exception as e:
+        raise UnsafePickleError("Could not unpickle data: {!r}".format(e))
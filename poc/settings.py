@@ -9,6 +9,27 @@ FAIL_DIR = WORK_DIR + "/failed/"
 NEW_DIR = WORK_DIR + "/new/"
 INCOMPLETE_DIR = WORK_DIR + "/incomplete/"
 
+# Parsed replays are cached here, keyed by replay contents and parser version, up to CACHE_MAX_SIZE bytes.
+# Off by default: hashing every replay and writing its entry costs more than the cache saves unless the
+# same replays are parsed again, e.g. when a directory is reprocessed into a fresh database.
+PARSE_CACHE = False
+CACHE_DIR = WORK_DIR + "/cache/"
+CACHE_MAX_SIZE = 512 * 1024 * 1024
+
+# wotstore --watch: seconds between scans of NEW_DIR, seconds a replay must stay unchanged before it
+# is processed, and replays queued per worker process
+WATCH_POLL_INTERVAL = 1.0
+WATCH_SETTLE_TIME = 2.0
+WATCH_PENDING_PER_WORKER = 4
+
+# wotserver: listening address, multipart field holding the replay, largest request accepted in bytes
+# and seconds a connection may go without sending data before it is dropped
+UPLOAD_HOST = ""
+UPLOAD_PORT = 8080
+UPLOAD_FIELD = "file"
+UPLOAD_MAX_SIZE = 64 * 1024 * 1024
+UPLOAD_TIMEOUT = 60
+
 BLOWFISH_KEY = ''.join(['\xDE', '\x72', '\xBE', '\xA0', '\xDE', '\x04', '\xBE', '\xB1',
                         '\xDE', '\xFE', '\xBE', '\xEF', '\xDE', '\xAD', '\xBE', '\xEF'])
 
@@ -38,23 +59,74 @@ VEHICLE_TANKMAN_TYPE_NAMES = ('commander', 'driver', 'radioman', 'gunner', 'load
 ## Database
 SQLITE_DB = os.path.abspath(os.path.dirname(__file__)) + "/wot.db"
 
-from pysqlite2 import dbapi2 as sqlite3
-db_conn = sqlite3.connect(SQLITE_DB)
-db_conn.row_factory = sqlite3.Row
+# (pid, connection) of the connection returned by get_db
+_db = (None, None)
+
+
+def get_db():
+    """
+    Returns the SQLite connection of this process, opened on first use. A process forked after the
+    connection was opened gets a connection of its own instead of sharing the parent's.
+    """
+    global _db
+    if _db[0] != os.getpid():
+        from pysqlite2 import dbapi2 as sqlite3
+        conn = sqlite3.connect(SQLITE_DB)
+        conn.row_factory = sqlite3.Row
+        _db = (os.getpid(), conn)
+    return _db[1]
+
+# Batched match writes: rows per transaction and maximum seconds between commits
+DB_BATCH_SIZE = 500
+DB_FLUSH_INTERVAL = 5.0
+# Journal mode and "pragma synchronous" level (OFF, NORMAL, FULL or EXTRA) used by the batch writer
+SQLITE_WAL = True
+SQLITE_SYNCHRONOUS = "NORMAL"
+# Matches buffered by the columnar exporter before a batch of files is written, and maximum seconds they are held
+EXPORT_BATCH_SIZE = 1000
+EXPORT_FLUSH_INTERVAL = 60.0
+
+
+# Stage timers and counters (wotstats), and the file their Prometheus text format is written to,
+# every STATS_WRITE_INTERVAL seconds in watch mode
+STATS = False
+STATS_FILE = None
+STATS_WRITE_INTERVAL = 15.0
 
 
 ## Logging settings
+LOG_FILE = "parser.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# Production logging: INFO level, so the per-replay details logged at DEBUG are skipped
+LOG_PRODUCTION = False
+
 default_formatter = logging.Formatter("%(asctime)s:%(levelname)s:%(message)s")
 rtb_formatter = logging.Formatter("%(asctime)s: %(message)s")
 
-console_handler = StreamHandler()
-console_handler.setFormatter(default_formatter)
+_logging_configured = False
+
+
+def configure_logging(production=None):
+    """
+    Attaches the console and rotating file handlers to the root logger, fed by a wotlog.QueueHandler
+    so the worker processes forked later leave the writing to this one. Called by the entry points
+    rather than on import, so modules can be imported without touching the logging setup.
+    production defaults to LOG_PRODUCTION.
+    """
+    global _logging_configured
+    if _logging_configured:
+        return
+    _logging_configured = True
+
+    console_handler = StreamHandler()
+    console_handler.setFormatter(default_formatter)
 
-default_handler = RotatingFileHandler("parser.log", "a", 1024 * 5, 3)
-default_handler.setLevel(logging.DEBUG)
-default_handler.setFormatter(default_formatter)
+    default_handler = RotatingFileHandler(LOG_FILE, "a", LOG_MAX_BYTES, LOG_BACKUP_COUNT)
+    default_handler.setLevel(logging.DEBUG)
+    default_handler.setFormatter(default_formatter)
 
-root = logging.getLogger()
-root.addHandler(console_handler)
-root.addHandler(default_handler)
-root.setLevel(logging.DEBUG)
+    import wotlog
+    root = logging.getLogger()
+    root.addHandler(wotlog.QueueHandler([console_handler, default_handler]))
+    root.setLevel(logging.INFO if (LOG_PRODUCTION if production is None else production) else logging.DEBUG)
@@ -0,0 +1,253 @@
+"""
+Benchmark of the replay parse stages on synthetic replays
+
+Generates replays in the layout extract_headers and the body readers
+expect: magic and block count, the JSON players and frags blocks, the
+pickled battle results with per-vehicle details, and a body that is zlib
+compressed, chained and Blowfish encrypted. Every stage then runs over all
+of them; the best of --repeat runs is reported as ms per replay, replays/s
+and MB/s of the bytes the stage consumes.
+
+The generated replays only depend on the command line, so numbers from
+different commits are comparable. Use --json to keep them for later.
+
+    python wotbench.py --replays 20 --vehicles 30 --body-size 2M
+"""
+
+import argparse
+import cPickle
+import json
+import logging
+import os
+import random
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+import settings
+import wotparse
+import wotstore
+from blowfish import get_cipher
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger()
+
+VERSION = 'World of Tanks v.0.8.6 #123'
+MAPS = ['Himmelsdorf', 'Malinovka', 'Prokhorovka', 'Ruinberg', 'Steppes']
+TANKS = ['ussr:T-34', 'ussr:IS', 'germany:Tiger-I', 'germany:PzVI', 'usa:M4_Sherman', 'uk:Churchill_I', 'france:AMX_13_75']
+
+
+def details_blob(rnd, vehicles):
+    """
+    Returns a details blob (see wotparse.decode_details) about vehicles, at most 10 of them
+    """
+    out = struct.pack('%di' % len(vehicles), *vehicles)
+    for v in vehicles:
+        out += struct.pack('<BbHHHHHHIH', rnd.randint(0, 3), -1, rnd.randint(0, 8), rnd.randint(0, 2), rnd.randint(0, 6),
+                           rnd.randint(0, 2000), rnd.randint(0, 500), rnd.randint(0, 500), rnd.choice([0, 0x01002005]), 0)
+    return out
+
+
+def body_filler(rnd, size):
+    """
+    Returns size bytes of packet-like data: a mix of random and repeating records and the odd
+    chat message, which compresses about as well as a real replay body
+    """
+    records = [''.join(chr(rnd.randint(0, 255)) for i in range(rnd.choice([8, 16, 24]))) for j in range(64)]
+    parts = []
+    n = 0
+    while n < size:
+        if rnd.random() < 0.01:
+            part = "<font color='#FF0000'>p{}&nbsp;:&nbsp;</font><font color='#FFFFFF'>gl hf</font>".format(rnd.randint(0, 29))
+        elif rnd.random() < 0.3:
+            part = struct.pack('<IIf', rnd.randint(0, 1 << 30), rnd.randint(0, 1 << 30), rnd.random())
+        else:
+            part = rnd.choice(records)
+        parts.append(part)
+        n += len(part)
+    return ''.join(parts)[:size]
+
+
+def unchain(data):
+    """
+    Inverse of wotparse.chain_xor: xors every 8 byte block with the previous plain text block
+    """
+    if numpy is not None:
+        blocks = numpy.frombuffer(data, dtype='<u8')
+        out = blocks.copy()
+        out[1:] ^= blocks[:-1]
+        return out.tobytes()
+
+    n = len(data) // 8
+    blocks = struct.unpack('<%dQ' % n, data)
+    return struct.pack('<%dQ' % n, *([blocks[0]] + [blocks[i] ^ blocks[i - 1] for i in xrange(1, n)]))
+
+
+def make_replay(fn, seed=1, vehicles=30, body_size=1024 * 1024, nblocks=3):
+    """
+    Writes a synthetic replay with the given number of vehicles and about body_size bytes of
+    decompressed body to fn
+    """
+    rnd = random.Random(seed)
+    vids = range(1000, 1000 + vehicles)
+    mapname = MAPS[seed % len(MAPS)]
+
+    players = {
+        'mapDisplayName': mapname,
+        'gameplayID': 'ctf',
+        'playerName': 'p0',
+        'vehicles': dict((str(v), {'team': 1 + i % 2, 'name': 'p{}'.format(i), 'vehicleType': rnd.choice(TANKS)})
+                         for i, v in enumerate(vids)),
+    }
+    frags = [{'isWinner': rnd.choice([-1, 0, 1])}, {}, dict((str(v), {'frags': rnd.randint(0, 3)}) for v in vids)]
+    results = {
+        'common': {'bonusType': 1, 'arenaCreateTime': 1360000000 + seed},
+        'personal': {'details': {}},
+        'vehicles': dict((v, {'accountDBID': 500000 + seed * 1000 + v, 'team': 1 + i % 2, 'damageDealt': rnd.randint(0, 3000),
+                              'details': details_blob(rnd, rnd.sample(vids, min(len(vids), rnd.randint(0, 10))))})
+                         for i, v in enumerate(vids)),
+    }
+    blocks = [json.dumps(players), json.dumps(frags), cPickle.dumps(results, 2)][:nblocks]
+    head = struct.pack('<Ii', wotparse.REPLAY_MAGIC, nblocks) + ''.join(struct.pack('<i', len(b)) + b for b in blocks)
+
+    # What read_version_and_blevel walks through before the packets
+    body = '\x00' * 12 + struct.pack('<i', len(VERSION)) + VERSION + '\x00' * 35
+    body += struct.pack('b', 2) + 'p0' + '\x00' * 14 + cPickle.dumps({'battleLevel': rnd.randint(1, 10)}, 2)
+    body += '\x00' * 33 + cPickle.dumps([(v, '\x01\x02' + rnd.choice(TANKS)) for v in vids], 2)
+    body += body_filler(rnd, max(body_size - len(body), 0))
+
+    data = zlib.compress(body)
+    data += '\x00' * (-len(data) % 8)
+    data = get_cipher(settings.BLOWFISH_KEY).encrypt_blocks(unchain(data))
+    with open(fn, 'wb') as f:
+        f.write(head + '\x00' * 8 + data)
+
+
+def timed(fn, files, repeat):
+    """
+    Runs fn on every file repeat times and returns the best total time
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for f in files:
+            fn(f)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(files, repeat):
+    """
+    Times every stage over files and returns a list of (stage, seconds, bytes consumed)
+    """
+    offsets = dict((f, wotparse.extract_headers(f, header_only=True)[3]) for f in files)
+    encrypted = sum(os.path.getsize(f) - offsets[f] - 8 for f in files)
+
+    def decrypt(f):
+        with open(f, 'rb') as fp:
+            for chunk in wotparse.decrypt_chunks(fp, offsets[f]):
+                pass
+
+    decrypted = {}
+    for f in files:
+        with open(f, 'rb') as fp:
+            decrypted[f] = list(wotparse.decrypt_chunks(fp, offsets[f]))
+    inflated = sum(sum(len(c) for c in wotparse.decompress_chunks(decrypted[f])) for f in files)
+
+    def decompress(f):
+        for chunk in wotparse.decompress_chunks(decrypted[f]):
+            pass
+
+    def version(f):
+        with wotparse.open_body(f, offsets[f], lazy=True) as body:
+            wotparse.extract_version_and_blevel(body)
+
+    def details(f):
+        results = wotparse.extract_headers(f, header_only=True)[2]
+        wotparse.details_columns(results['vehicles'])
+
+    header_bytes = sum(offsets.values())
+    total = sum(os.path.getsize(f) for f in files)
+    stages = [
+        ('classify', wotparse.classify_replay, None),
+        ('headers', lambda f: wotparse.extract_headers(f, header_only=True), header_bytes),
+        ('headers_full', wotparse.extract_headers, header_bytes),
+        ('decrypt', decrypt, encrypted),
+        ('decompress', decompress, inflated),
+        ('version', version, None),
+        ('chats', lambda f: list(wotparse.stream_chats(f)), inflated),
+        ('parse_file', wotstore.parse_file, total),
+    ]
+    if numpy is not None:
+        stages.append(('details', details, None))
+
+    out = [(name, timed(fn, files, repeat), size) for name, fn, size in stages]
+
+    parsed = [wotstore.parse_file(f) for f in files]
+
+    def store(matches):
+        from pysqlite2 import dbapi2 as sqlite3
+        writer = wotstore.MatchWriter(conn=sqlite3.connect(':memory:'), batch_size=len(matches), wal=False)
+        for m in matches:
+            writer.add(m)
+        writer.close()
+    out.append(('store', timed(store, [parsed], repeat), None))
+    return out
+
+
+def report(results, nfiles):
+    print "{:<14} {:>10} {:>12} {:>10}".format("stage", "ms/replay", "replays/s", "MB/s")
+    for name, seconds, size in results:
+        print "{:<14} {:>10.2f} {:>12.1f} {:>10}".format(
+            name, 1000.0 * seconds / nfiles, nfiles / seconds if seconds else 0,
+            "{:.2f}".format(size / 1048576.0 / seconds) if size and seconds else "-")
+
+
+def size_arg(s):
+    units = {'k': 1024, 'm': 1024 * 1024}
+    if s[-1:].lower() in units:
+        return int(float(s[:-1]) * units[s[-1:].lower()])
+    return int(s)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the replay parse stages on synthetic replays")
+    parser.add_argument("--replays", type=int, default=20, help="number of replays to generate")
+    parser.add_argument("--vehicles", type=int, default=30, help="vehicles per battle")
+    parser.add_argument("--body-size", type=size_arg, default=1024 * 1024, help="decompressed body size, e.g. 512K or 4M")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the best one is reported")
+    parser.add_argument("--dir", help="keep the generated replays in this directory")
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARN)
+
+    path = args.dir or tempfile.mkdtemp(prefix="wotbench-")
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    try:
+        start = time.time()
+        files = []
+        for i in range(args.replays):
+            fn = os.path.join(path, "bench-{}-{}-{}.wotreplay".format(args.vehicles, args.body_size, i))
+            if not os.path.exists(fn):
+                make_replay(fn, seed=i, vehicles=args.vehicles, body_size=args.body_size)
+            files.append(fn)
+        print "{} replays of {} vehicles and {:.1f} MB body, {:.1f} MB on disk, ready in {:.1f}s".format(
+            len(files), args.vehicles, args.body_size / 1048576.0,
+            sum(os.path.getsize(f) for f in files) / 1048576.0, time.time() - start)
+
+        results = run(files, args.repeat)
+        report(results, len(files))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'replays': len(files), 'vehicles': args.vehicles, 'body_size': args.body_size,
+                           'stages': dict((name, {'seconds': s, 'bytes': size}) for name, s, size in results)}, f, indent=2)
+    finally:
+        if not args.dir:
+            shutil.rmtree(path)
@@ -0,0 +1,198 @@
+"""
+On-disk cache of parsed replays
+
+Every entry holds what the parse stages get out of one replay (players,
+frags, battle results, version, battle level and roster) as a zlib
+compressed pickle, named after the SHA-1 of the replay contents and the
+version of the parser sources. Editing the parser changes that version,
+so entries written by older code are never read again and are the first
+to go when the cache is pruned. Apart from those, the least recently
+used entries are removed once the cache grows past its size limit.
+
+The size of the cache is kept in shared memory, so the worker processes
+forked after the cache is created keep one count between them.
+"""
+
+import cPickle
+import ctypes
+import hashlib
+import logging
+import multiprocessing
+import os
+import zlib
+import wotparse
+import safepickle
+import blowfish
+
+log = logging.getLogger()
+
+CACHE_SUFFIX = ".cache"
+HASH_CHUNK_SIZE = 1024 * 1024
+# Bumped when the layout of a cache entry changes
+CACHE_FORMAT = 1
+
+
+def parser_version():
+    """
+    Returns a hash of the cache format and the source of the parser modules
+    """
+    h = hashlib.sha1(str(CACHE_FORMAT))
+    for module in (wotparse, safepickle, blowfish):
+        with open(os.path.splitext(module.__file__)[0] + ".py", "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+def content_hash(fn, data=None):
+    """
+    SHA-1 of the contents of file fn, or of data if it is already in memory or mapped
+    """
+    if data is not None:
+        return hashlib.sha1(data).hexdigest()
+
+    h = hashlib.sha1()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ReplayCache(object):
+    """
+    Parsed replays in directory 'path', kept under about max_size bytes.
+
+    get() and put() take the key returned by key(). The battle results are
+    stored as the results pickle read from the replay and come back as a
+    wotparse.DeferredResults, so reading an entry stays cheap when they are
+    not used.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.version = parser_version()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._size = multiprocessing.Value(ctypes.c_int64, sum(size for name, size, mtime in self._entries()))
+
+    @property
+    def size(self):
+        return self._size.value
+
+    def _grow(self, n):
+        with self._size.get_lock():
+            self._size.value += n
+            return self._size.value
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((name, st.st_size, st.st_mtime))
+        return entries
+
+    def key(self, fn, data=None):
+        return "{}-{}".format(content_hash(fn, data), self.version)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + CACHE_SUFFIX)
+
+    def get(self, key):
+        """
+        Returns the cached dict for key, or None if there is no usable entry
+        """
+        fn = self._file(key)
+        try:
+            with open(fn, "rb") as f:
+                entry = cPickle.loads(zlib.decompress(f.read()))
+        except IOError:
+            return None
+        except Exception as e:
+            log.warn("Dropping unreadable cache entry %s: %s", key, e)
+            self._grow(-self._remove(fn))
+            return None
+
+        # Bump the mtime, which is what the eviction goes by
+        try:
+            os.utime(fn, None)
+        except OSError:
+            pass
+        entry['results'] = wotparse.DeferredResults(entry['results'])
+        return entry
+
+    def put(self, key, players, frags, results, version, blevel, roster):
+        """
+        Stores the parse of a replay. results is the DeferredResults returned by extract_headers.
+        """
+        entry = {
+            'players': players,
+            'frags': frags,
+            'results': results.data,
+            'version': version,
+            'blevel': blevel,
+            'roster': roster,
+        }
+        data = zlib.compress(cPickle.dumps(entry, 2))
+
+        fn = self._file(key)
+        tmp = "{}.{}.tmp".format(fn, os.getpid())
+        try:
+            replaced = os.path.getsize(fn)
+        except OSError:
+            replaced = 0
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.rename(tmp, fn)
+        except (IOError, OSError) as e:
+            log.warn("Could not write cache entry %s: %s", key, e)
+            self._remove(tmp)
+            return
+
+        if self._grow(len(data) - replaced) > self.max_size:
+            self.evict()
+
+    def _remove(self, fn):
+        """
+        Removes file fn, if it is there, and returns its size
+        """
+        try:
+            size = os.path.getsize(fn)
+            os.unlink(fn)
+            return size
+        except OSError:
+            return 0
+
+    def evict(self):
+        """
+        Removes the entries of other parser versions, then the least recently used ones until the cache
+        is back under 90% of max_size
+        """
+        # One process evicts at a time, the others wait for it before counting the entries
+        with self._size.get_lock():
+            current = []
+            removed = 0
+            for name, size, mtime in self._entries():
+                if name.endswith("-{}{}".format(self.version, CACHE_SUFFIX)):
+                    current.append((mtime, name, size))
+                else:
+                    self._remove(os.path.join(self.path, name))
+                    removed += 1
+
+            current.sort()
+            size = sum(size for mtime, name, size in current)
+            target = self.max_size * 0.9
+            for mtime, name, entry_size in current:
+                if size <= target:
+                    break
+                self._remove(os.path.join(self.path, name))
+                size -= entry_size
+                removed += 1
+            self._size.value = size
+
+        log.info("Evicted %s cache entries, %s bytes left", removed, size)
@@ -0,0 +1,90 @@
+"""
+Logging for long running ingestion
+
+QueueHandler puts records on a multiprocessing queue and a listener thread
+in the process that created it passes them on to the real handlers. Pool
+workers forked from that process inherit the handler and log through the
+same queue, so a single process does all the file and console I/O and the
+rotating log file has one writer.
+
+replay_summary() logs the single summary record of a replay.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+
+summary_log = logging.getLogger("replay")
+
+
+class QueueHandler(logging.Handler):
+    """
+    Hands records to handlers from a listener thread in the process that created it
+    """
+
+    def __init__(self, handlers):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.queue = multiprocessing.Queue()
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._listen, name="log-listener")
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self._stop)
+
+    def _listen(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def _stop(self):
+        # Only the listening process stops the listener, after the records queued before
+        if self.pid == os.getpid() and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def prepare(self, record):
+        """
+        Formats the message and traceback in the logging process, so the record can be pickled
+        and the listener never sees arguments that have changed since
+        """
+        if record.exc_info:
+            self.format(record)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self._stop()
+        if self.pid == os.getpid():
+            for handler in self.handlers:
+                handler.close()
+        logging.Handler.close(self)
+
+
+def replay_summary(fname, outcome, timings, **fields):
+    """
+    Logs one record for replay fname with its outcome, any extra fields and the seconds spent in
+    each stage of timings, as key=value pairs. The values are also attached to the record as
+    'replay' for formatters that want them structured.
+    """
+    if not summary_log.isEnabledFor(logging.INFO):
+        return
+
+    values = [('file', os.path.basename(fname)), ('outcome', outcome)] + sorted(fields.items())
+    values += [(stage, round(seconds, 4)) for stage, seconds in sorted(timings.items())]
+    summary_log.info(" ".join("%s=%%s" % k for k, v in values), *[v for k, v in values],
+                     extra={'replay': dict(values)})
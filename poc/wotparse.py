@@ -13,30 +13,84 @@ import re
 import traceback
 import zlib
 import glob
+import mmap
+import tempfile
+import UserDict
 
-from blowfish import Blowfish
+from blowfish import get_cipher
 from binascii import b2a_hex
 from pprint import pprint
-import cPickle as pickle
+import safepickle
 import settings
+import wotstats
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 log = logging.getLogger()
 
+# Bytes of encrypted body read and decrypted in one go, a multiple of the cipher block size
+DECRYPT_CHUNK_SIZE = 1024 * 1024
+
+# Decompressed replay bodies larger than this are spooled to a temporary file
+SPOOL_MAX_SIZE = 32 * 1024 * 1024
+
+# Bytes of encrypted body decrypted per step when the body is read lazily
+LAZY_CHUNK_SIZE = 8 * 1024
+
+# First 4 bytes of every replay file
+REPLAY_MAGIC = 0x11343212
+# Replays with more header blocks than this are not taken for replays
+MAX_BLOCKS = 16
+
+# Classes returned by classify_replay
+REPLAY_OK = 'ok'
+REPLAY_INCOMPLETE = 'incomplete'
+REPLAY_TRUNCATED = 'truncated'
+REPLAY_INVALID = 'invalid'
+
+# Start of every pickle in the replay body: the PROTO opcode followed by protocol version 2
+PICKLE_SIGNATURE = '\x80\x02'
+# Bytes searched for PICKLE_SIGNATURE after the player name and after the battle level pickle
+PICKLE_SEARCH_WINDOW = 64
+
+# A chat line is a run of up to 4 <font ...>text</font> elements. Every part is bounded and
+# the elements can't overlap, so matching is linear and a match is at most MAX_CHAT_LENGTH long.
+CHAT_PATTERN = re.compile(r'(?:<font[^<>\n]{0,200}>[^<\n]{0,700}</font>){1,4}')
+MAX_CHAT_LENGTH = 4 * (len('<font>') + 200 + 700 + len('</font>'))
+CHAT_CHUNK_SIZE = 64 * 1024
+
+_cipher = None
+# Replay version -> offsets of the battle level and roster pickles, see read_version_and_blevel
+_pickle_offsets = {}
+
+
+DETAIL_FIELDS = [
+  "spotted",
+  "deathReason",
+  "hits",
+  "he_hits",
+  "pierced",
+  "damageDealt",
+  "damageAssistedTrack",
+  "damageAssistedRadio",
+  "crits",
+  "fire"
+]
+
+if numpy is not None:
+    # One 20 byte details record, same layout as '<BbHHHHHHIH'
+    DETAIL_DTYPE = numpy.dtype(list(zip(DETAIL_FIELDS, ['u1', 'i1', '<u2', '<u2', '<u2', '<u2', '<u2', '<u2', '<u4', '<u2'])))
+    VEHICLE_DETAIL_DTYPE = numpy.dtype([('vehicle', '=i4')] + DETAIL_DTYPE.descr)
+
 
 # From https://github.com/raszpl/wotdecoder/blob/master/wotdecoder.py
 def decode_details(data):
-    detail = [
-      "spotted",
-      "deathReason",
-      "hits",
-      "he_hits",
-      "pierced",
-      "damageDealt",
-      "damageAssistedTrack",
-      "damageAssistedRadio",
-      "crits",
-      "fire"
-    ]
+    if numpy is not None:
+        return dict((r[0], dict(zip(DETAIL_FIELDS, r[1:]))) for r in decode_details_array(data).tolist())
+
     details = {}
 
     binlen = len(data) // 22
@@ -46,156 +100,563 @@ def decode_details(data):
             offset = 4*binlen + x*datalen
             vehic = struct.unpack('i', data[x*4:x*4+4])[0]
             detail_values = struct.unpack('<BbHHHHHHIH', data[offset:offset + datalen])
-            details[vehic] = dict(zip(detail, detail_values))
+            details[vehic] = dict(zip(DETAIL_FIELDS, detail_values))
     except Exception:
         print traceback.format_exc()
     return details
 
-# Phalynx, vBAddict.net    
-def decode_crits(details_data):
+
+def decode_details_array(data):
+    """
+    Decodes a details blob into a structured array of VEHICLE_DETAIL_DTYPE: the vehicle id
+    prefix followed by the 20 byte records, all read with np.frombuffer. Requires NumPy.
+    """
+    binlen = len(data) // 22
+    count = max(min(binlen, (len(data) - 4 * binlen) // DETAIL_DTYPE.itemsize), 0)
+
+    out = numpy.empty(count, dtype=VEHICLE_DETAIL_DTYPE)
+    out['vehicle'] = numpy.frombuffer(data, dtype='=i4', count=count)
+    records = numpy.frombuffer(data, dtype=DETAIL_DTYPE, count=count, offset=4 * binlen)
+    for name in DETAIL_FIELDS:
+        out[name] = records[name]
+    return out
+
+
+def details_columns(vehicles):
+    """
+    Decodes the details of every vehicle of the battle results ('vehicles' of extract_headers)
+    into columns, a dict of NumPy arrays: 'owner' is the vehicle the details belong to, 'vehicle'
+    the one they refer to, followed by DETAIL_FIELDS. Totals over a battle, or over many battles
+    once concatenated, are then plain array reductions. Requires NumPy.
+    """
+    parts = []
+    for owner, v in vehicles.items():
+        data = dict.__getitem__(v, 'details')
+        if isinstance(data, str):
+            arr = decode_details_array(data)
+        else:
+            arr = numpy.array([(vid, ) + tuple(d[name] for name in DETAIL_FIELDS) for vid, d in data.items()],
+                              dtype=VEHICLE_DETAIL_DTYPE)
+        parts.append((owner, arr))
+
+    owners = [numpy.full(len(arr), owner, dtype=numpy.int64) for owner, arr in parts]
+    columns = {'owner': numpy.concatenate(owners or [numpy.empty(0, numpy.int64)])}
+    arrays = numpy.concatenate([arr for owner, arr in parts] or [numpy.empty(0, VEHICLE_DETAIL_DTYPE)])
+    for name in arrays.dtype.names:
+        columns[name] = arrays[name]
+    return columns
+
+
+def crit_table(names, bits):
+    """
+    Maps every bits wide mask value to a tuple of (number of named bits set, names of those bits)
+    """
+    table = []
+    for mask in range(1 << bits):
+        found = tuple(name for shift, name in enumerate(names) if 1 << shift & mask)
+        table.append((len(found), found))
+    return tuple(table)
+
+
+DEVICE_CRITS = crit_table(settings.VEHICLE_DEVICE_TYPE_NAMES, 12)
+TANKMAN_CRITS = crit_table(settings.VEHICLE_TANKMAN_TYPE_NAMES, 8)
+
+
+# Phalynx, vBAddict.net
+def decode_crits(details_data, compact=False):
     """
     Decodes the crits introduced in 0.8.6.0
     Refer also to http://wiki.vbaddict.net/pages/Crits
+
+    With compact set, only the count and the raw masks (critsCriticalDevices, critsDestroyedDevices
+    and critsDestroyedTankmen) are stored; expand_crits adds the name lists later if they are needed.
     """
     for vehicleid, detail_values in details_data.items():
+        crits = detail_values['crits']
+        if crits > 0:
+            criticalDevices = crits & 4095
+            destroyedDevices = crits >> 12 & 4095
+            destroyedTankmen = crits >> 24 & 255
+            detail_values['critsCount'] = (DEVICE_CRITS[criticalDevices][0] + DEVICE_CRITS[destroyedDevices][0] +
+                                           TANKMAN_CRITS[destroyedTankmen][0])
+
+            if compact:
+                detail_values['critsCriticalDevices'] = criticalDevices
+                detail_values['critsDestroyedDevices'] = destroyedDevices
+                detail_values['critsDestroyedTankmen'] = destroyedTankmen
+            else:
+                detail_values['critsDestroyedTankmenList'] = list(TANKMAN_CRITS[destroyedTankmen][1])
+                detail_values['critsCriticalDevicesList'] = list(DEVICE_CRITS[criticalDevices][1])
+                detail_values['critsDestroyedDevicesList'] = list(DEVICE_CRITS[destroyedDevices][1])
+
+    return details_data
 
-		if detail_values['crits']>0:
-			destroyedTankmen = detail_values['crits'] >> 24 & 255
-			destroyedDevices = detail_values['crits'] >> 12 & 4095
-			criticalDevices = detail_values['crits'] & 4095
-			critsCount = 0
-			
-			criticalDevicesList = []
-			destroyedDevicesList = []
-			destroyedTankmenList = []
-			
-			for shift in range(len(VEHICLE_DEVICE_TYPE_NAMES)):
-				if 1 << shift & criticalDevices:
-					critsCount += 1
-					criticalDevicesList.append(VEHICLE_DEVICE_TYPE_NAMES[shift])
-			
-				if 1 << shift & destroyedDevices:
-					critsCount += 1
-					destroyedDevicesList.append(VEHICLE_DEVICE_TYPE_NAMES[shift])
-			
-			for shift in range(len(VEHICLE_TANKMAN_TYPE_NAMES)):
-				if 1 << shift & destroyedTankmen:
-					critsCount += 1
-					destroyedTankmenList.append(VEHICLE_TANKMAN_TYPE_NAMES[shift])
-	
-			details_data[vehicleid]['critsCount'] = critsCount
-			details_data[vehicleid]['critsDestroyedTankmenList'] = destroyedTankmenList
-			details_data[vehicleid]['critsCriticalDevicesList'] = criticalDevicesList
-			details_data[vehicleid]['critsDestroyedDevicesList'] = destroyedDevicesList
-		
-	return details_data
-
-
-def extract_headers(fn):
+
+def expand_crits(detail_values):
     """
-    Extracts and returns a tuple of the following data structures, plus the offset of the compress archive stream
-    * players
-    * frags
-    * detailed battle results
+    Adds the crit name lists to one details entry decoded with compact crits
     """
-    try:
-        with open(fn, "rb") as f:
-            f.seek(4, 0)
-            nblocks = struct.unpack("i", f.read(4))[0]
-            log.info("Got {} blocks in replay {}".format(nblocks, os.path.basename(fn)))
+    if detail_values['crits'] > 0 and 'critsCriticalDevicesList' not in detail_values:
+        crits = detail_values['crits']
+        detail_values['critsDestroyedTankmenList'] = list(TANKMAN_CRITS[crits >> 24 & 255][1])
+        detail_values['critsCriticalDevicesList'] = list(DEVICE_CRITS[crits & 4095][1])
+        detail_values['critsDestroyedDevicesList'] = list(DEVICE_CRITS[crits >> 12 & 4095][1])
+    return detail_values
+
+
+class DeferredVehicle(dict):
+    """
+    Vehicle entry of the battle results whose 'details' blob is only decoded
+    (decode_details and decode_crits) the first time it is looked up.
+    """
+
+    def __init__(self, data, compact_crits=False):
+        dict.__init__(self, data)
+        self.compact_crits = compact_crits
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if key == 'details' and isinstance(value, str):
+            value = decode_crits(decode_details(value), self.compact_crits)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+class DeferredResults(UserDict.DictMixin):
+    """
+    Battle results block of a replay, unpickled on first access. The vehicles
+    are DeferredVehicle instances, so their details are decoded on demand too.
+    The pickle itself stays available as 'data'.
+    """
+
+    def __init__(self, data, compact_crits=False):
+        self.data = data
+        self._results = None
+        self.compact_crits = compact_crits
+
+    def load(self):
+        if self._results is None:
+            results = safepickle.loads(self.data)
+            results['personal']['details'] = decode_crits(results['personal']['details'], self.compact_crits)
+            for k, v in results['vehicles'].items():
+                results['vehicles'][k] = DeferredVehicle(v, self.compact_crits)
+            self._results = results
+        return self._results
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self.load()[key] = value
+
+    def __delitem__(self, key):
+        del self.load()[key]
+
+    def keys(self):
+        return self.load().keys()
+
+
+def classify_replay(fn):
+    """
+    Classifies replay fn from its first 8 bytes and the lengths in its block table alone, without
+    reading the blocks:
+    * REPLAY_INVALID if it does not start with REPLAY_MAGIC and a sane block count
+    * REPLAY_INCOMPLETE if it has fewer than 3 blocks, as replays of battles left early do
+    * REPLAY_TRUNCATED if the file ends before the blocks or the encrypted body
+    * REPLAY_OK otherwise
+    """
+    with open(fn, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        head = f.read(8)
+        if len(head) < 8:
+            return REPLAY_TRUNCATED
+        magic, nblocks = struct.unpack("<Ii", head)
+        if magic != REPLAY_MAGIC or not 0 <= nblocks <= MAX_BLOCKS:
+            return REPLAY_INVALID
+        if nblocks < 3:
+            return REPLAY_INCOMPLETE
+
+        pos = 8
+        for i in range(3):
+            f.seek(pos)
+            data = f.read(4)
+            if len(data) < 4:
+                return REPLAY_TRUNCATED
+            bs = struct.unpack("<i", data)[0]
+            if bs < 0:
+                return REPLAY_INVALID
+            pos += 4 + bs
+
+    # The body starts 8 bytes after the blocks, see decrypt_chunks
+    if size <= pos + 8:
+        return REPLAY_TRUNCATED
+    return REPLAY_OK
+
+
+class ReplayReader(object):
+    """
+    A replay file opened and memory mapped once. headers() parses the header blocks straight
+    from the mapping and body() returns a zero-copy view of the encrypted body after them, which
+    decrypt_chunks() and open_body() decrypt without reading the file again. Python 2 mmap
+    objects don't support memoryview, so the view is a buffer.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self._f = open(fn, "rb")
+        try:
+            size = os.fstat(self._f.fileno()).st_size
+            # Empty files can't be mapped
+            self.map = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if size else ''
+        except:
+            self._f.close()
+            raise
+        self.offset = None
+
+    def headers(self, header_only=False, compact_crits=False):
+        """
+        Returns the same tuple as extract_headers
+        """
+        fn = self.fn
+        buf = self.map
+        try:
+            nblocks = struct.unpack_from("i", buf, 4)[0]
+            log.debug("Got %s blocks in replay %s", nblocks, os.path.basename(fn))
             if nblocks < 3:
-                log.warn("Replay {} is incomplete".format(os.path.basename(fn)))
+                log.warn("Replay %s is incomplete", os.path.basename(fn))
                 return None, None, None, None
-            else:
-                bs = struct.unpack("i", f.read(4))[0]
-                players = json.loads(f.read(bs).decode('utf-8'))
-                log.info("Loaded player data, {} bytes".format(bs))
 
-                bs = struct.unpack("i", f.read(4))[0]
+            blocks = []
+            pos = 8
+            for i in range(3):
+                bs = struct.unpack_from("i", buf, pos)[0]
+                pos += 4
+                if bs < 0 or pos + bs > len(buf):
+                    raise EOFError("Block {} of {} bytes is truncated".format(i, bs))
+                blocks.append((pos, bs))
+                pos += bs
 
-                frags = json.loads(f.read(bs).decode('utf-8'))
-                log.info("Loaded frag data, {} bytes".format(bs))
+            (ppos, pbs), (fpos, fbs), (rpos, rbs) = blocks
 
-                bs = struct.unpack("i", f.read(4))[0]
-                try:
-                    results = pickle.loads(f.read(bs))
-										results['personal']['details'] = decode_crits(results['personal']['details'])
+            players = json.loads(buf[ppos:ppos + pbs].decode('utf-8'))
+            log.debug("Loaded player data, %s bytes", pbs)
+
+            frags = json.loads(buf[fpos:fpos + fbs].decode('utf-8'))
+            log.debug("Loaded frag data, %s bytes", fbs)
 
+            results = DeferredResults(buf[rpos:rpos + rbs], compact_crits)
+            if not header_only:
+                try:
+                    results = results.load()
                     for k, v in results['vehicles'].items():
-                        results['vehicles'][k]['details'] = decode_details(v['details'])
-                        results['vehicles'][k]['details'] = decode_crits(v['details'])
+                        results['vehicles'][k] = dict(v, details=v['details'])
 
-                    log.info("Loaded battle results, {} bytes".format(bs))
-                except pickle.UnpicklingError as e:
+                    log.debug("Loaded battle results, %s bytes", rbs)
+                except safepickle.UnsafePickleError as e:
                     log.warn("Could not load battle results")
                     log.warn(e)
                     return None, None, None, None
 
-                return players, frags, results, f.tell()
-    except (EOFError, IOError):
-        log.warn("Could not read file {}".format(fn))
-    except ValueError as e:
-        log.warn("Error: " + str(e))
-    except:
-        log.warn(traceback.format_exc())
+            self.offset = pos
+            return players, frags, results, pos
+        except (EOFError, IOError, struct.error):
+            log.warn("Could not read file %s", fn)
+        except ValueError as e:
+            log.warn("Error: %s", e)
+        except:
+            log.warn(traceback.format_exc())
+        return None, None, None, None
+
+    def body(self):
+        """
+        Returns a buffer over the encrypted body, from the first block decrypt_chunks uses. headers()
+        must have succeeded first.
+        """
+        return buffer(self.map, self.offset + 8)
+
+    def decrypt_chunks(self, chunk_size=DECRYPT_CHUNK_SIZE):
+        body = self.body()
+        return decrypt_stream(buffer(body, i, chunk_size) for i in xrange(0, len(body), chunk_size))
+
+    def open_body(self, lazy=False):
+        return open_body(self.fn, self.offset, lazy, reader=self)
+
+    def close(self):
+        if self.map:
+            self.map.close()
+            self.map = ''
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def extract_headers(fn, header_only=False, compact_crits=False):
+    """
+    Extracts and returns a tuple of the following data structures, plus the offset of the compress archive stream
+    * players
+    * frags
+    * detailed battle results
+
+    The header blocks are parsed from a memory mapping of the file, see ReplayReader. With header_only set,
+    the battle results are returned as a DeferredResults, so the pickle and the per-vehicle details are only
+    decoded if they are used. compact_crits is passed on to decode_crits.
+    """
+    try:
+        with ReplayReader(fn) as replay:
+            return replay.headers(header_only, compact_crits)
+    except EnvironmentError:
+        log.warn("Could not read file %s", fn)
     return None, None, None, None
 
 
+def replay_cipher():
+    """
+    Returns the Blowfish instance for the replay key, so the key schedule only runs once per process
+    """
+    global _cipher
+    if _cipher is None:
+        _cipher = get_cipher(settings.BLOWFISH_KEY)
+    return _cipher
+
+
+def chain_xor(data, prev=0):
+    """
+    Undoes the block chaining of the replay body: every 8 byte block of the decrypted
+    buffer is XORed with the previous output block. 'prev' is the last block of the
+    previous buffer (0 for the first one). Returns the chained buffer and its last block.
+    """
+    n = len(data) // 8
+    if not n:
+        return data, prev
+
+    if numpy is not None:
+        blocks = numpy.bitwise_xor.accumulate(numpy.frombuffer(data, dtype='<u8'))
+        blocks ^= numpy.uint64(prev)
+        return blocks.tobytes(), int(blocks[-1])
+
+    blocks = []
+    for b in struct.unpack("<{}Q".format(n), data):
+        prev ^= b
+        blocks.append(prev)
+    return struct.pack("<{}Q".format(n), *blocks), prev
+
+
+def decrypt_chunks(f, offset=0, chunk_size=DECRYPT_CHUNK_SIZE):
+    """
+    Generator yielding the decrypted and chained replay body from file object f,
+    chunk_size bytes at a time. The first block after offset is skipped.
+    """
+    f.seek(offset + 8)
+    return decrypt_stream(iter(lambda: f.read(chunk_size), ''))
+
+
+def decrypt_stream(chunks):
+    """
+    Generator decrypting and chaining an iterable of encrypted body chunks, strings or
+    buffers whose lengths are multiples of 8 except for the last one, which is zero padded
+    to the cipher block size.
+    """
+    bf = replay_cipher()
+    stats = wotstats.stats
+    prev = 0
+    for data in chunks:
+        if len(data) % 8:
+            data = str(data) + '\x00' * (8 - len(data) % 8)  # pad for correct blocksize
+
+        with stats.timer('decrypt'):
+            data, prev = chain_xor(bf.decrypt_blocks(data), prev)
+        stats.count('bytes', 'encrypted', len(data))
+        yield data
+
+
 def decrypt_file(fn, offset=0):
-    bc = 0
-    pb = None
-    bf = Blowfish(settings.BLOWFISH_KEY)
-    log.info("Decrypting from offset {}".format(offset))
+    log.debug("Decrypting from offset %s", offset)
     of = fn + ".tmp"
     with open(fn, 'rb') as f:
-        f.seek(offset)
         with open(of, 'wb') as out:
-            while True:
-                b = f.read(8)
-                if not b:
-                    break
-
-                if len(b) < 8:
-                    b += '\x00' * (8 - len(b))  # pad for correct blocksize
-
-                if bc > 0:
-                    db = bf.decrypt(b)
-                    if pb:
-                        db = ''.join([chr(int(b2a_hex(a), 16) ^ int(b2a_hex(b), 16)) for a, b in zip(db, pb)])
-
-                    pb = db
-                    out.write(db)
-                bc += 1
-            return of
-    return None
+            for data in decrypt_chunks(f, offset):
+                out.write(data)
+    return of
 
 
 def decompress_file(fn):
-    log.info("Decompressing")
+    log.debug("Decompressing")
     with open(fn, 'rb') as i:
         with open(fn + '.out', 'wb') as o:
-            o.write(zlib.decompress(i.read()))
+            with wotstats.stats.timer('decompress'):
+                data = zlib.decompress(i.read())
+            wotstats.stats.count('bytes', 'decompressed', len(data))
+            o.write(data)
             return fn + ".out"
         os.unlink(fn)
 
 
-def extract_roster(f):
-    log.info("Attempting to find roster offset around {}".format(f.tell()))
-    cp = f.tell()
-    f.seek(33, 1)
+def decompress_chunks(chunks):
+    """
+    Generator inflating an iterable of compressed chunks, such as the output of
+    decrypt_chunks. Stops at the end of the zlib stream, dropping the block padding.
+    """
+    d = zlib.decompressobj()
+    stats = wotstats.stats
+    for data in chunks:
+        with stats.timer('decompress'):
+            out = d.decompress(data)
+        stats.count('bytes', 'decompressed', len(out))
+        if out:
+            yield out
+        if d.unused_data:
+            break
+
+    out = d.flush()
+    if out:
+        yield out
+
+
+class LazyBody(object):
+    """
+    Read-only file object over a replay body that decrypts and inflates the stream
+    only as far as has been read so far. Seeking is free, reading past the inflated
+    data resumes the stream and seeking relative to the end drains it.
+    """
+
+    def __init__(self, fn, offset, chunk_size=LAZY_CHUNK_SIZE, reader=None):
+        if reader is None:
+            self._f = open(fn, 'rb')
+            self._chunks = decompress_chunks(decrypt_chunks(self._f, offset, chunk_size))
+        else:
+            self._f = None
+            self._chunks = decompress_chunks(reader.decrypt_chunks(chunk_size))
+        self._buf = bytearray()
+        self._pos = 0
+
+    def _fill(self, size=None):
+        while self._chunks is not None and (size is None or len(self._buf) < size):
+            try:
+                self._buf += next(self._chunks)
+            except StopIteration:
+                self.close()
+
+    def read(self, n=-1):
+        if n < 0:
+            self._fill()
+            end = len(self._buf)
+        else:
+            end = self._pos + n
+            self._fill(end)
+        data = str(self._buf[self._pos:end])
+        self._pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        start = self._pos
+        while True:
+            i = self._buf.find('\n', start)
+            if i >= 0:
+                n = i + 1 - self._pos
+                return self.read(n if size < 0 else min(n, size))
+            if self._chunks is None or 0 <= size <= len(self._buf) - self._pos:
+                return self.read(size)
+            start = len(self._buf)
+            self._fill(start + 1)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            self._fill()
+            offset += len(self._buf)
+        self._pos = max(offset, 0)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if self._chunks is not None:
+            self._chunks.close()
+            self._chunks = None
+            if self._f:
+                self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_body(fn, offset, lazy=False, reader=None):
+    """
+    Decrypts and decompresses the replay body at offset straight into a seekable
+    buffer, without writing .tmp/.out files. The buffer stays in memory unless it
+    grows past SPOOL_MAX_SIZE. With lazy set, a LazyBody is returned instead and
+    only the part of the body that is actually read gets processed.
+    Given a ReplayReader, the body is decrypted from its mapping of the file.
+    The caller is responsible for closing it.
+    """
+    if lazy:
+        return LazyBody(fn, offset, reader=reader)
+
+    log.debug("Decrypting and decompressing from offset %s", offset)
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    if reader is not None:
+        for data in decompress_chunks(reader.decrypt_chunks()):
+            out.write(data)
+    else:
+        with open(fn, 'rb') as f:
+            for data in decompress_chunks(decrypt_chunks(f, offset)):
+                out.write(data)
+    out.seek(0)
+    return out
 
-    offsets = (32, 33, 34, )
-    for off in offsets:
+
+def find_pickles(f, start, delta=None):
+    """
+    Returns the offsets after start in a decompressed replay body where a pickle may begin: start + delta
+    if a pickle begins there, followed by every PICKLE_SIGNATURE within PICKLE_SEARCH_WINDOW bytes of start.
+    """
+    found = []
+    if delta is not None:
+        f.seek(start + delta, 0)
+        if f.read(len(PICKLE_SIGNATURE)) == PICKLE_SIGNATURE:
+            found.append(start + delta)
+
+    f.seek(start, 0)
+    window = f.read(PICKLE_SEARCH_WINDOW)
+    i = window.find(PICKLE_SIGNATURE)
+    while i >= 0:
+        if start + i not in found:
+            found.append(start + i)
+        i = window.find(PICKLE_SIGNATURE, i + 1)
+    return found
+
+
+def load_pickle_near(f, start, delta=None, valid=None):
+    """
+    Unpickles the first pickle after start that loads and passes valid, trying the offsets returned
+    by find_pickles in turn, so a stale delta or a stray signature doesn't hide the pickle. Returns
+    the object and its offset relative to start, or (None, None). The file is left positioned after
+    the pickle, or at start if none was found.
+    """
+    for off in find_pickles(f, start, delta):
+        f.seek(off, 0)
         try:
-            f.seek(cp + off, 0)
-            roster = pickle.load(f)
-            if roster:
-                log.info("Found roster at {}".format(cp + off))
-                return roster
-        except:
-            pass
-    log.info("Didn't find roster")
-    return None
+            obj = safepickle.load(f)
+        except Exception as e:
+            log.debug("Could not unpickle data at %s: %s", off, e)
+            continue
+        if valid is None or valid(obj):
+            return obj, off - start
+        log.debug("Unexpected %s pickled at %s", type(obj).__name__, off)
+
+    f.seek(start, 0)
+    return None, None
 
 
 def extract_vehicle_data(rosterEntry):
@@ -226,73 +687,128 @@ def extract_vehicle_data(rosterEntry):
     return ret
 
 
-def extract_version_and_blevel(fn):
+def read_version_and_blevel(f):
+    """
+    Reads the replay version, battle level and roster from a decompressed replay
+    body, given as a seekable file object.
+    """
+    f.seek(12, 0)
+    bs = struct.unpack("i", f.read(4))[0]
+    version = f.read(bs)
     try:
-        with open(fn, 'rb') as f:
+        x = re.match("^World.*?of.*?Tanks v\.(\d+)\.(\d+)\.(\d+)\s#(\d+)", version.replace('\xc2\xa0', ' '))
+        version = '.'.join(x.groups()[:-1]) + ' ' + x.groups()[-1]
+    except Exception:  # must be 8.6
+        version = version.replace(', ', '.')
+    log.debug("Replay version %s", version)
+
+    f.seek(35, 1)
+    bs = int(struct.unpack("b", f.read(1))[0])
+    playername = f.read(bs)
+    log.debug("Player name %s", playername)
+
+    # The pickles sit at the same offsets in every replay of a version, so after the first
+    # replay they are loaded straight from the cached offsets instead of searched for
+    blevel_delta, roster_delta = _pickle_offsets.get(version, (None, None))
+
+    blevel, blevel_delta = load_pickle_near(f, f.tell(), blevel_delta, lambda obj: isinstance(obj, dict))
+    log.debug("Battle level %s", blevel)
+    if blevel is None:
+        blevel = {}
+
+    log.debug("Attempting to find roster offset around %s", f.tell())
+    roster, roster_delta = load_pickle_near(f, f.tell(), roster_delta, lambda obj: isinstance(obj, (list, tuple)) and len(obj) > 0)
+    if roster:
+        log.debug("Found roster %s bytes after the battle level", roster_delta)
+        if blevel_delta is not None:
+            _pickle_offsets[version] = (blevel_delta, roster_delta)
+    else:
+        log.debug("Didn't find roster")
+        roster = None
+
+    blevel = blevel.get('battleLevel', 0)
+    return version, blevel, roster
 
-            f.seek(12, 0)
-            bs = struct.unpack("i", f.read(4))[0]
-            version = f.read(bs)
-            try:
-                x = re.match("^World.*?of.*?Tanks v\.(\d+)\.(\d+)\.(\d+)\s#(\d+)", version.replace('\xc2\xa0', ' '))
-                version = '.'.join(x.groups()[:-1]) + ' ' + x.groups()[-1]
-            except Exception:  # must be 8.6
-                version = version.replace(', ', '.')
-            log.info("Replay version {}".format(version))
-
-            f.seek(35, 1)
-            bs = int(struct.unpack("b", f.read(1))[0])
-            playername = f.read(bs)
-            log.info("Player name {}".format(playername))
-
-            offsets = [14, 13, 15]
-            co = f.tell()
-            blevel = {}
-            for off in offsets:
-                try:
-                    f.seek(co + off, 0)
-                    blevel = pickle.load(f)
-                    log.debug("Battle level {}".format(blevel))
-                except:
-                    continue
 
-            roster = extract_roster(f)
-            blevel = blevel.get('battleLevel', 0)
-            return version, blevel, roster
+def extract_version_and_blevel(fn):
+    """
+    Takes either the name of a decompressed replay body or the buffer returned by open_body
+    """
+    if hasattr(fn, 'read'):
+        return read_version_and_blevel(fn)
+
+    try:
+        with open(fn, 'rb') as f:
+            return read_version_and_blevel(f)
     except IOError as e:
         log.warn(e)
-        return None, None
+        return None, None, None
+
+
+def iter_chats(chunks):
+    """
+    Generator yielding (offset, message) for every chat message in a stream given as an iterable
+    of string chunks. Only the tail of each chunk that could hold an unfinished message is carried
+    over to the next one, so memory use doesn't grow with the stream.
+    """
+    carry = ''
+    pos = 0  # stream offset of carry
+    chunks = iter(chunks)
+    final = False
+    while not final:
+        data = next(chunks, None)
+        final = data is None
+        buf = carry + (data or '')
+
+        # Matches are at most MAX_CHAT_LENGTH long, so any match starting before limit is complete
+        limit = len(buf) if final else len(buf) - MAX_CHAT_LENGTH
+        scanned = 0
+        for m in CHAT_PATTERN.finditer(buf):
+            if m.start() >= limit:
+                break
+            yield pos + m.start(), m.group()
+            scanned = m.end()
+
+        start = max(scanned, limit, 0)
+        carry = buf[start:]
+        pos += start
+
+
+def stream_chats(fn):
+    """
+    Generator yielding (offset, message) for the chat messages in the body of replay fn,
+    decrypting and inflating it chunk by chunk as the messages are consumed
+    """
+    with ReplayReader(fn) as replay:
+        if replay.headers(header_only=True)[3] is None:
+            return
+
+        for chat in iter_chats(decompress_chunks(replay.decrypt_chunks())):
+            yield chat
 
 
 def extract_chats(fn):
     with open(fn, 'rb') as f:
-        s = f.read()
-        p = re.compile(r'<font.*>.*?</font>')
-        return p.findall(s)
+        return [message for offset, message in iter_chats(iter(lambda: f.read(CHAT_CHUNK_SIZE), ''))]
 
 if __name__ == "__main__":
+    settings.configure_logging()
     if len(sys.argv) > 1 and os.path.exists(sys.argv[1]):
-        decfile = None
-        outfile = None
         if os.path.isdir(sys.argv[1]):
             files = glob.glob(sys.argv[1] + "/*.wotreplay")
         else:
             files = (sys.argv[1], )
         try:
             for fname in files:
-                log.info("Processing {}".format(fname))
+                log.info("Processing %s", fname)
                 players, frags, details, boff = extract_headers(fname)
 
                 if not boff or players is None:
-                    log.warn("Could not extract headers from {}".format(fname))
+                    log.warn("Could not extract headers from %s", fname)
                     continue
 
-                decfile = decrypt_file(fname, boff)
-                outfile = decompress_file(decfile)
-                os.unlink(decfile)
-
-                version, bt, roster = extract_version_and_blevel(outfile)
-                os.unlink(outfile)
+                with open_body(fname, boff, lazy=True) as body:
+                    version, bt, roster = extract_version_and_blevel(body)
 
                 print "-" * 80
                 print "Filename: {}".format(fname)
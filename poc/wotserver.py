@@ -0,0 +1,271 @@
+"""
+HTTP endpoint for the replay uploader
+
+Accepts the multipart/form-data POST sent by uploader/Uploader/Program.cs
+(the replay in a "file" field) and streams the replay into settings.NEW_DIR.
+The upload is written to a .part file next to its final name and renamed
+once complete, so the parse pipeline only ever sees whole replays. Replies
+with "OK", or "FAIL" to make the uploader try once more; the replays of a
+failed request are removed so the retry does not store them twice.
+Connections that stall for settings.UPLOAD_TIMEOUT seconds are dropped.
+
+Try it with: curl -F file=@some.wotreplay http://localhost:8080/index.php
+"""
+
+import argparse
+import cgi
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import traceback
+import BaseHTTPServer
+import SocketServer
+import settings
+
+log = logging.getLogger()
+
+READ_CHUNK_SIZE = 64 * 1024
+MAX_HEADER_SIZE = 8 * 1024
+UPLOAD_PATHS = ('/', '/index.php')
+
+
+class MultipartError(ValueError):
+    pass
+
+
+class MultipartReader(object):
+    """
+    Reads the parts of a multipart/form-data body of length bytes from file object f without holding
+    more than about chunk_size bytes of it in memory. Call next_part() to get the headers of each
+    part, then optionally read_part() to get its data; parts that are not read are skipped.
+    """
+
+    def __init__(self, f, boundary, length, chunk_size=READ_CHUNK_SIZE):
+        self.f = f
+        self.remaining = length
+        self.chunk_size = chunk_size
+        self.delimiter = '\r\n--' + boundary
+        # The uploader starts the body with a CRLF before the first boundary, other clients
+        # don't. With one prepended, the first delimiter matches either way.
+        self.buf = '\r\n'
+        self.in_part = True
+        self.finished = False
+
+    def _fill(self):
+        if self.remaining <= 0:
+            raise MultipartError("Body ended before the closing boundary")
+        data = self.f.read(min(self.chunk_size, self.remaining))
+        if not data:
+            raise MultipartError("Connection closed during upload")
+        self.remaining -= len(data)
+        self.buf += data
+
+    def _copy_to_delimiter(self, write):
+        keep = len(self.delimiter) - 1
+        while True:
+            i = self.buf.find(self.delimiter)
+            if i >= 0:
+                if write:
+                    write(self.buf[:i])
+                self.buf = self.buf[i + len(self.delimiter):]
+                return
+
+            # Everything except a possible start of the delimiter is part data
+            if len(self.buf) > keep:
+                if write:
+                    write(self.buf[:-keep])
+                self.buf = self.buf[-keep:]
+            self._fill()
+
+    def _read_line(self):
+        while '\r\n' not in self.buf:
+            if len(self.buf) > MAX_HEADER_SIZE:
+                raise MultipartError("Part header too long")
+            self._fill()
+        line, self.buf = self.buf.split('\r\n', 1)
+        return line
+
+    def next_part(self):
+        """
+        Returns the headers of the next part as a dict keyed by lower case name, or None after the last part
+        """
+        if self.finished:
+            return None
+        if self.in_part:
+            self._copy_to_delimiter(None)
+
+        while len(self.buf) < 2:
+            self._fill()
+        if self.buf.startswith('--'):
+            self.finished = True
+            return None
+        # Anything up to the CRLF after the boundary is padding
+        self._read_line()
+
+        headers = {}
+        while True:
+            line = self._read_line()
+            if not line:
+                break
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise MultipartError("Malformed part header")
+            headers[name.strip().lower()] = value.strip()
+
+        self.in_part = True
+        return headers
+
+    def read_part(self, write):
+        """
+        Passes the data of the current part to write, in pieces
+        """
+        if not self.in_part or self.finished:
+            raise MultipartError("No part to read")
+        self._copy_to_delimiter(write)
+        self.in_part = False
+
+
+def replay_name(filename):
+    """
+    Returns a safe file name for an upload, given the file name (the uploader sends the full Windows path)
+    """
+    name = re.split(r'[\\/]', filename)[-1]
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', name).lstrip('.')
+    if not name.endswith('.wotreplay'):
+        name += '.wotreplay'
+    return name
+
+
+class UploadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Socket timeout, so a stalled client does not hold its thread and .part file
+    timeout = settings.UPLOAD_TIMEOUT
+
+    def reply(self, code, text):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def do_POST(self):
+        if self.path.split('?')[0] not in UPLOAD_PATHS:
+            return self.reply(404, "FAIL")
+
+        ctype, params = cgi.parse_header(self.headers.getheader('content-type', ''))
+        if ctype != 'multipart/form-data' or not params.get('boundary'):
+            return self.reply(400, "FAIL")
+        try:
+            length = int(self.headers.getheader('content-length'))
+        except (TypeError, ValueError):
+            return self.reply(411, "FAIL")
+        if length > settings.UPLOAD_MAX_SIZE:
+            return self.reply(413, "FAIL")
+
+        reader = MultipartReader(self.rfile, params['boundary'], length)
+        stored = []
+        try:
+            while True:
+                headers = reader.next_part()
+                if headers is None:
+                    break
+                disposition, dparams = cgi.parse_header(headers.get('content-disposition', ''))
+                if dparams.get('name') == settings.UPLOAD_FIELD and dparams.get('filename'):
+                    stored.append(self.server.store(replay_name(dparams['filename']), reader))
+        except socket.timeout:
+            log.warn("Upload from %s timed out", self.client_address[0])
+            self.discard(stored)
+            self.close_connection = 1
+            return
+        except MultipartError as e:
+            log.warn("Bad upload from %s: %s", self.client_address[0], e)
+            self.discard(stored)
+            return self.reply(400, "FAIL")
+        except (IOError, OSError):
+            log.warn(traceback.format_exc())
+            self.discard(stored)
+            return self.reply(200, "FAIL")
+
+        if not stored:
+            return self.reply(400, "FAIL")
+        self.reply(200, "OK")
+
+    def discard(self, stored):
+        """
+        Removes the replays stored for a request that failed, unless they were picked up already
+        """
+        for fn in stored:
+            try:
+                os.unlink(fn)
+            except OSError as e:
+                log.warn("Could not remove %s: %s", fn, e)
+
+    def log_message(self, format, *args):
+        log.info("%s %s", self.client_address[0], format % args)
+
+
+class UploadServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server storing uploaded replays in directory dest
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, dest=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, UploadHandler)
+        self.dest = dest or settings.NEW_DIR
+        self.lock = threading.Lock()
+
+    def store(self, name, reader):
+        """
+        Writes the current part of reader to a .part file in dest and renames it to name, or to
+        a numbered variant of it if name is taken. Returns the final path.
+        """
+        fd, tmp = tempfile.mkstemp(suffix='.part', prefix='.upload-', dir=self.dest)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                reader.read_part(out.write)
+        except:
+            os.unlink(tmp)
+            raise
+
+        base, ext = os.path.splitext(name)
+        with self.lock:
+            fn = os.path.join(self.dest, name)
+            n = 0
+            while os.path.exists(fn):
+                n += 1
+                fn = os.path.join(self.dest, "{}-{}{}".format(base, n, ext))
+            os.rename(tmp, fn)
+
+        log.info("Stored upload %s, %s bytes", os.path.basename(fn), os.path.getsize(fn))
+        return fn
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accept replay uploads over HTTP")
+    parser.add_argument("--host", default=settings.UPLOAD_HOST, help="address to listen on")
+    parser.add_argument("--port", type=int, default=settings.UPLOAD_PORT, help="port to listen on")
+    parser.add_argument("--process", action="store_true", help="also parse and store the uploaded replays")
+    parser.add_argument("--workers", type=int, default=1, help="number of parser processes with --process")
+    args = parser.parse_args()
+    settings.configure_logging()
+
+    server = UploadServer((args.host, args.port))
+    log.info("Listening on %s:%s", args.host, args.port)
+    if args.process:
+        import wotstore
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        # Uploads are renamed into place whole, so they need no settling time. The server is started
+        # once the workers are forked, so none is forked while a request thread runs.
+        wotstore.watch_dir(server.dest, args.workers, settle_time=0, on_start=thread.start)
+    else:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
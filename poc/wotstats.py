@@ -0,0 +1,188 @@
+"""
+Stage timers and counters for the replay pipeline
+
+The pipeline reports to the module level 'stats' object: stage timers
+(stats.timer('decrypt') as a context manager), byte counters and replay
+outcome counters (stats.count('replays', 'ok')). Until enable() is called
+it is a NullStats whose methods do nothing, so the calls left in the hot
+paths cost a method call each.
+
+Stage times are exclusive: time spent in a stage timed inside another one
+is only counted for the inner stage, so the stages add up to the total.
+Worker processes hand their numbers to the parent with take() and merge().
+scope() collects the numbers of one piece of work, such as a replay, on
+their own, whether or not instrumentation is on.
+"""
+
+import contextlib
+import os
+import time
+from collections import Counter
+
+
+class _Timer(object):
+
+    __slots__ = ('stats', 'stage', 'start')
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        self.stats.nested.append(0.0)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        elapsed = time.time() - self.start
+        inner = self.stats.nested.pop()
+        if self.stats.nested:
+            self.stats.nested[-1] += elapsed
+        self.stats.add_time(self.stage, elapsed - inner)
+
+
+class Stats(object):
+
+    enabled = True
+
+    def __init__(self):
+        self.times = Counter()
+        self.calls = Counter()
+        self.counters = Counter()
+        # Time spent in stages nested in each running timer
+        self.nested = []
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def add_time(self, stage, seconds):
+        self.times[stage] += seconds
+        self.calls[stage] += 1
+
+    def count(self, metric, label, n=1):
+        self.counters[(metric, label)] += n
+
+    def take(self):
+        """
+        Returns the numbers collected so far, in a form merge() accepts, and starts over
+        """
+        data = (self.times, self.calls, self.counters)
+        self.times, self.calls, self.counters = Counter(), Counter(), Counter()
+        return data
+
+    def merge(self, data):
+        if data is None:
+            return
+        times, calls, counters = data
+        self.times.update(times)
+        self.calls.update(calls)
+        self.counters.update(counters)
+
+    def summary(self):
+        """
+        Returns the collected numbers as lines of text
+        """
+        total = sum(self.times.values())
+        lines = []
+        for stage, seconds in self.times.most_common():
+            lines.append("stage {:<12} {:>10.3f}s {:>5.1f}% {:>8} calls".format(
+                stage, seconds, 100.0 * seconds / total if total else 0, self.calls[stage]))
+        for (metric, label), n in sorted(self.counters.items()):
+            lines.append("{} {:<16} {:>12}".format(metric, label, n))
+        return lines
+
+    def prometheus(self):
+        """
+        Returns the collected numbers in the Prometheus text exposition format
+        """
+        lines = ["# TYPE wot_stage_seconds_total counter"]
+        lines += ['wot_stage_seconds_total{{stage="{}"}} {:.6f}'.format(s, t) for s, t in sorted(self.times.items())]
+        lines.append("# TYPE wot_stage_calls_total counter")
+        lines += ['wot_stage_calls_total{{stage="{}"}} {}'.format(s, n) for s, n in sorted(self.calls.items())]
+
+        metrics = {}
+        for (metric, label), n in self.counters.items():
+            metrics.setdefault(metric, []).append((label, n))
+        for metric, values in sorted(metrics.items()):
+            lines.append("# TYPE wot_{}_total counter".format(metric))
+            lines += ['wot_{}_total{{kind="{}"}} {}'.format(metric, label, n) for label, n in sorted(values)]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, fn):
+        """
+        Writes prometheus() to fn, replacing it in one step for collectors reading the file
+        """
+        tmp = "{}.{}.tmp".format(fn, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(self.prometheus())
+        os.rename(tmp, fn)
+
+
+class _NullTimer(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+class NullStats(object):
+    """
+    Stand-in for Stats while instrumentation is off
+    """
+
+    enabled = False
+    _timer = _NullTimer()
+
+    def timer(self, stage):
+        return self._timer
+
+    def add_time(self, stage, seconds):
+        pass
+
+    def count(self, metric, label, n=1):
+        pass
+
+    def take(self):
+        return None
+
+    def merge(self, data):
+        pass
+
+
+stats = NullStats()
+
+
+def enable():
+    global stats
+    if not stats.enabled:
+        stats = Stats()
+    return stats
+
+
+def reset():
+    """
+    Drops the numbers collected so far, e.g. the copy a forked worker starts with
+    """
+    stats.take()
+
+
+@contextlib.contextmanager
+def scope():
+    """
+    Makes a new Stats the module 'stats' for the enclosed code and yields it, so its numbers can be
+    read on their own afterwards. They are added to the enclosing stats at the end.
+    """
+    global stats
+    outer = stats
+    inner = stats = Stats()
+    try:
+        yield inner
+    finally:
+        stats = outer
+        outer.merge((inner.times, inner.calls, inner.counters))
+        # Time the enclosed stages took is not the enclosing stage's own
+        if outer.enabled and outer.nested:
+            outer.nested[-1] += sum(inner.times.values())
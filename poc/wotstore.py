@@ -1,27 +1,272 @@
+import argparse
+import functools
 import glob
+import itertools
+import multiprocessing
 import os
+import Queue
+import signal
 import sys
+import time
 import settings
+import safepickle
+import wotstats
 import md5
 import logging
 import traceback
+import urllib
 from pprint import pprint
-from wotparse import extract_headers, decompress_file, decrypt_file, extract_version_and_blevel
+from collections import Counter
+from wotparse import ReplayReader, extract_version_and_blevel, details_columns, DETAIL_FIELDS
+from wotparse import classify_replay, REPLAY_OK, REPLAY_INCOMPLETE, REPLAY_TRUNCATED
+from wotcache import ReplayCache
+from wotlog import replay_summary
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 log = logging.getLogger()
 
 
-def create_db():
-    c = settings.db_conn.cursor()
+TEAM_SIZE = 15
+
+MATCH_COLUMNS = ['battlehash', 'version', 'player_side', 'outcome', 'mapname', 'battletier', 'gamemode', 'gametype',
+                 'player_team_kills', 'opfor_team_kills']
+for t in range(1, TEAM_SIZE + 1):
+    MATCH_COLUMNS.append("player_team_tank_{}".format(t))
+    MATCH_COLUMNS.append("opfor_team_tank_{}".format(t))
+
+INSERT_MATCH = "insert into matchdata ({}) values ({})".format(', '.join(MATCH_COLUMNS), ', '.join('?' * len(MATCH_COLUMNS)))
+INSERT_MATCH_IGNORE = INSERT_MATCH.replace("insert into", "insert or ignore into", 1)
+
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# Outcomes MatchWriter passes to on_saved: committed, already stored, failed, or not written because
+# the database was busy, so the replay is to be tried again later
+SAVE_OK = 'ok'
+SAVE_DUPLICATE = 'duplicate'
+SAVE_FAILED = 'fail'
+SAVE_RETRY = 'retry'
+
+# Columns of the exported tables. Version and map name are the partition keys, kept in the directory names.
+EXPORT_MATCH_COLUMNS = [c for c in MATCH_COLUMNS[:10] if c not in ('version', 'mapname')]
+EXPORT_DETAIL_COLUMNS = ['battlehash', 'owner', 'vehicle'] + DETAIL_FIELDS
+
+# Values of match_vehicle.side
+PLAYER_SIDE = 1
+OPFOR_SIDE = 2
+
+# pragma user_version of a database with the normalized vehicle tables populated
+SCHEMA_VERSION = 1
+
+
+def create_db(conn=None):
+    conn = conn or settings.get_db()
+    c = conn.cursor()
     ddl = "create table if not exists matchdata (battlehash text primary key, version text, player_side int, outcome text, mapname text, battletier int, gamemode text, gametype text, player_team_kills int, opfor_team_kills int, "
-    x = []
-    for t in range(1, 16):
-        x.append("player_team_tank_{}".format(t))
-        x.append("opfor_team_tank_{}".format(t))
-    ddl += ", ".join(x)
+    ddl += ", ".join(MATCH_COLUMNS[10:])
     ddl += ")"
     c.execute(ddl)
+
+    # Normalized team compositions, one row per tank and team slot
+    c.execute("create table if not exists vehicle (id integer primary key, name text not null unique)")
+    c.execute("create table if not exists match_vehicle (battlehash text not null, side int not null, slot int not null, "
+              "vehicle_id int not null references vehicle (id), primary key (battlehash, side, slot))")
+    c.execute("create index if not exists match_vehicle_by_vehicle on match_vehicle (vehicle_id, side, battlehash)")
+    c.execute("create index if not exists matchdata_by_map on matchdata (mapname, outcome)")
     c.close()
+    migrate_db(conn)
+
+
+def migrate_db(conn=None):
+    """
+    Fills the normalized vehicle tables from the tank columns of matchdata in a single pass,
+    once per database
+    """
+    conn = conn or settings.get_db()
+    if conn.execute("pragma user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+
+    c = conn.cursor()
+    try:
+        vehicles = load_vehicle_ids(c)
+        rows = []
+        for match in c.execute("select {} from matchdata".format(', '.join(['battlehash'] + MATCH_COLUMNS[10:]))).fetchall():
+            match = tuple(match)
+            for i, tank in enumerate(match[1:]):
+                if tank:
+                    side = OPFOR_SIDE if i % 2 else PLAYER_SIDE
+                    rows.append((match[0], side, i // 2 + 1, str(tank)))
+        insert_match_vehicles(c, rows, vehicles)
+        c.execute("pragma user_version = {}".format(SCHEMA_VERSION))
+        conn.commit()
+        log.info("Migrated team compositions of %s tanks", len(rows))
+    except:
+        conn.rollback()
+        raise
+    finally:
+        c.close()
+
+
+def load_vehicle_ids(c):
+    return dict((str(name), vid) for name, vid in c.execute("select name, id from vehicle"))
+
+
+def insert_match_vehicles(c, rows, vehicles):
+    """
+    Inserts (battlehash, side, slot, vehicle name) rows into match_vehicle, adding unknown names
+    to the vehicle table. vehicles is the name to id cache and gets updated.
+    """
+    for name in set(row[3] for row in rows):
+        if name not in vehicles:
+            c.execute("insert into vehicle (name) values (?)", (name, ))
+            vehicles[name] = c.lastrowid
+    c.executemany("insert or ignore into match_vehicle (battlehash, side, slot, vehicle_id) values (?, ?, ?, ?)",
+                  [(h, side, slot, vehicles[name]) for h, side, slot, name in rows])
+
+
+def tank_win_rate(name, side=PLAYER_SIDE, conn=None):
+    """
+    Returns (matches, wins) for matches with the given tank on the given side. The outcome is
+    always from the point of view of the player who recorded the replay.
+    """
+    conn = conn or settings.get_db()
+    return tuple(conn.execute(
+        "select count(distinct mv.battlehash), count(distinct case when m.outcome = 'win' then m.battlehash end) "
+        "from vehicle v join match_vehicle mv on mv.vehicle_id = v.id and mv.side = ? "
+        "join matchdata m on m.battlehash = mv.battlehash where v.name = ?", (side, name)).fetchone())
+
+
+def tank_stats(side=PLAYER_SIDE, conn=None):
+    """
+    Returns (tank, matches, wins) for every tank seen on the given side
+    """
+    conn = conn or settings.get_db()
+    return [tuple(r) for r in conn.execute(
+        "select v.name, count(distinct mv.battlehash), count(distinct case when m.outcome = 'win' then m.battlehash end) "
+        "from match_vehicle mv join vehicle v on v.id = mv.vehicle_id "
+        "join matchdata m on m.battlehash = mv.battlehash where mv.side = ? group by mv.vehicle_id", (side, ))]
+
+
+def map_stats(conn=None):
+    """
+    Returns (map, matches, wins) for every map
+    """
+    conn = conn or settings.get_db()
+    return [tuple(r) for r in conn.execute(
+        "select mapname, count(*), sum(outcome = 'win') from matchdata group by mapname")]
+
+
+# battlehash values already in matchdata, loaded by process_dir before the workers start. The
+# workers add the matches stored since with refresh_known_hashes.
+known_hashes = set()
+# Highest matchdata rowid in known_hashes, and when refresh_known_hashes last ran
+known_rowid = 0
+known_refreshed = 0
+
+
+# ReplayCache used by parse_file, set up by process_dir when settings.PARSE_CACHE is on
+replay_cache = None
+
+
+def refresh_known_hashes(conn=None):
+    """
+    Adds the battlehash values stored since the last call to known_hashes, reading only the new rows
+    """
+    global known_rowid, known_refreshed
+    conn = conn or settings.get_db()
+    for rowid, h in conn.execute("select rowid, battlehash from matchdata where rowid > ?", (known_rowid, )):
+        known_hashes.add(str(h))
+        known_rowid = max(known_rowid, rowid)
+    known_refreshed = time.time()
+
+
+class ColumnarExporter(object):
+    """
+    Writes parsed matches to columnar files under path, partitioned by replay version and map:
+
+        path/matches/version=<version>/map=<map name>/part-<pid>-<n>.parquet
+        path/details/version=<version>/map=<map name>/part-<pid>-<n>.parquet
+
+    'matches' holds one row per match (EXPORT_MATCH_COLUMNS) and 'details' one row per vehicle
+    pair of the battle results details (EXPORT_DETAIL_COLUMNS). Matches are buffered and written
+    once batch_size of them are pending or flush_interval seconds have passed since the last
+    flush. The files are Parquet when pyarrow is installed and
+    NumPy .npz archives of the same columns otherwise. The matches passed to add() need the
+    'vehicleDetails' returned by parse_file with vehicle_details set.
+    """
+
+    def __init__(self, path, batch_size=None, flush_interval=None):
+        if numpy is None:
+            raise RuntimeError("Columnar export requires NumPy")
+        self.path = path
+        self.batch_size = batch_size or settings.EXPORT_BATCH_SIZE
+        self.flush_interval = settings.EXPORT_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.partitions = {}
+        self.pending = 0
+        self.parts = 0
+        self.exported = 0
+        self.last_flush = time.time()
+
+    def add(self, mdata):
+        matches, details = self.partitions.setdefault((mdata['replayVersion'], mdata['map']), ([], []))
+        row = dict(zip(MATCH_COLUMNS, match_row(mdata)))
+        matches.append([row[c] for c in EXPORT_MATCH_COLUMNS])
+
+        columns = dict(mdata['vehicleDetails'])
+        # With an explicit dtype, a match without detail rows does not make the column float64
+        columns['battlehash'] = numpy.full(len(columns['owner']), mdata['hash'], dtype='S32')
+        details.append(columns)
+
+        self.pending += 1
+        if self.pending >= self.batch_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def poll(self):
+        """
+        Flushes the pending matches once flush_interval has passed, for callers that add matches irregularly
+        """
+        if self.pending and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        partitions, self.partitions = self.partitions, {}
+        self.pending = 0
+        self.last_flush = time.time()
+        for (version, mapname), (matches, details) in partitions.items():
+            partition = "version={}/map={}".format(urllib.quote(str(version), ''), urllib.quote(mapname.encode('utf-8'), ''))
+            match_columns = dict(zip(EXPORT_MATCH_COLUMNS, zip(*matches)))
+            detail_columns = {}
+            for name in EXPORT_DETAIL_COLUMNS:
+                detail_columns[name] = numpy.concatenate([numpy.asarray(d[name]) for d in details])
+
+            self.parts += 1
+            part = "part-{}-{:05d}".format(os.getpid(), self.parts)
+            self._write(os.path.join(self.path, "matches", partition, part), EXPORT_MATCH_COLUMNS, match_columns)
+            self._write(os.path.join(self.path, "details", partition, part), EXPORT_DETAIL_COLUMNS, detail_columns)
+            self.exported += len(matches)
+            log.info("Exported %s matches to %s", len(matches), partition)
+
+    def _write(self, fn, names, columns):
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        if pyarrow:
+            arrays = [columns[n] if isinstance(columns[n], numpy.ndarray) else list(columns[n]) for n in names]
+            table = pyarrow.Table.from_arrays([pyarrow.array(a) for a in arrays], names)
+            pyarrow.parquet.write_table(table, fn + ".parquet")
+        else:
+            numpy.savez_compressed(fn + ".npz", **dict((n, numpy.asarray(columns[n])) for n in names))
+
+    def close(self):
+        self.flush()
 
 
 def get_team_frags(players, fragdata):
@@ -40,48 +285,230 @@ def get_match_hash(details, mapname):
     return md5.new(mapname + ''.join(s + p)).hexdigest()
 
 
-def save_match_data(mdata):
-    create_db()
-    dml = "insert into matchdata ({}) values({})"
-
-    data = {
-        'battlehash': mdata['hash'],
-        'player_side': mdata['playerSide'],
-        'version': mdata['replayVersion'],
-        'outcome': mdata['outcome'],
-        'mapname': mdata['map'],
-        'gamemode': mdata['gamemode'],
-        'gametype': mdata['gametype'],
-        'battletier': mdata['battleTier'] or 0
-    }
-
-    opfor = 2 if 1 == int(mdata['playerSide']) else 1
-    data['player_team_kills'] = mdata['teams'][mdata['playerSide']]['kills']
-    data['opfor_team_kills'] = mdata['teams'][opfor]['kills']
-
-    x = 1
-    for tank in mdata['teams'][mdata['playerSide']]['vehicles']:
-        data['player_team_tank_{}'.format(x)] = tank
-        x += 1
+def match_row(mdata):
+    """
+    Returns the matchdata row for mdata as a tuple in MATCH_COLUMNS order
+    """
+    side = mdata['playerSide']
+    opfor = 2 if 1 == int(side) else 1
+    row = [
+        mdata['hash'],
+        mdata['replayVersion'],
+        side,
+        mdata['outcome'],
+        mdata['map'],
+        mdata['battleTier'] or 0,
+        mdata['gamemode'],
+        mdata['gametype'],
+        mdata['teams'][side]['kills'],
+        mdata['teams'][opfor]['kills'],
+    ]
+
+    player_tanks = mdata['teams'][side]['vehicles'][:TEAM_SIZE]
+    opfor_tanks = mdata['teams'][opfor]['vehicles'][:TEAM_SIZE]
+    player_tanks += [None] * (TEAM_SIZE - len(player_tanks))
+    opfor_tanks += [None] * (TEAM_SIZE - len(opfor_tanks))
+    for tanks in zip(player_tanks, opfor_tanks):
+        row.extend(tanks)
+    return tuple(row)
+
+
+def match_vehicle_rows(mdata):
+    """
+    Returns the (battlehash, side, slot, vehicle name) rows of both teams of mdata
+    """
+    side = mdata['playerSide']
+    opfor = 2 if 1 == int(side) else 1
+    rows = []
+    for team, vside in ((side, PLAYER_SIDE), (opfor, OPFOR_SIDE)):
+        for slot, tank in enumerate(mdata['teams'][team]['vehicles'][:TEAM_SIZE]):
+            rows.append((mdata['hash'], vside, slot + 1, tank))
+    return rows
 
-    x = 1
-    for tank in mdata['teams'][opfor]['vehicles']:
-        data['opfor_team_tank_{}'.format(x)] = tank
-        x += 1
 
-    dml = dml.format(','.join(data.keys()), ("?," * len(data.keys()))[:-1])
-    c = settings.db_conn.cursor()
+def save_match_data(mdata):
+    create_db()
+    conn = settings.get_db()
+    c = conn.cursor()
+    with wotstats.stats.timer('save'):
+        try:
+            c.execute(INSERT_MATCH, match_row(mdata))
+            insert_match_vehicles(c, match_vehicle_rows(mdata), load_vehicle_ids(c))
+            conn.commit()
+            c.close()
+            return True
+        except Exception as e:
+            conn.rollback()
+            log.warn(e)
+            return False
+
+
+class MatchWriter(object):
+    """
+    Buffers match rows and writes them with a single executemany per transaction, once
+    batch_size rows are pending or flush_interval seconds have passed since the last flush.
+    Rows whose battlehash is already stored are skipped. If a batch fails, its matches are
+    written one at a time, so one bad row only fails its own match. on_saved, if given, is
+    called with (tag, outcome) for every match passed to add() once it has been written,
+    where outcome is SAVE_OK, SAVE_DUPLICATE for a match that was already stored, SAVE_FAILED,
+    or SAVE_RETRY when the database was busy. During those calls save_time holds the 'save'
+    stage seconds of the flush per match.
+    """
+
+    def __init__(self, conn=None, batch_size=None, flush_interval=None, wal=None, synchronous=None, on_saved=None):
+        self.conn = conn or settings.get_db()
+        self.batch_size = batch_size or settings.DB_BATCH_SIZE
+        self.flush_interval = settings.DB_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.on_saved = on_saved
+        self.matches = []  # (matchdata row, match_vehicle rows)
+        self.tags = []
+        self.inserted = 0
+        self.duplicates = 0
+        self.save_time = 0.0
+        self.last_flush = time.time()
+
+        synchronous = (synchronous or settings.SQLITE_SYNCHRONOUS or '').upper()
+        if synchronous and synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError("Unknown synchronous level {}".format(synchronous))
+
+        # The pragmas can't run inside the transaction the driver would open for them
+        isolation_level = self.conn.isolation_level
+        self.conn.isolation_level = None
+        try:
+            if settings.SQLITE_WAL if wal is None else wal:
+                self.conn.execute("pragma journal_mode=wal")
+            if synchronous:
+                self.conn.execute("pragma synchronous={}".format(synchronous))
+        finally:
+            self.conn.isolation_level = isolation_level
+
+        create_db(self.conn)
+        self.conn.commit()
+        self.vehicles = load_vehicle_ids(self.conn.cursor())
+
+    def add(self, mdata, tag=None):
+        self.matches.append((match_row(mdata), match_vehicle_rows(mdata)))
+        self.tags.append(tag)
+        if len(self.matches) >= self.batch_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def poll(self):
+        """
+        Flushes the pending rows once flush_interval has passed, for callers that add rows irregularly
+        """
+        if self.matches and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def _busy(self, e):
+        """
+        Returns True if error e means another connection holds the database lock, rather than a problem with the data
+        """
+        return isinstance(e, self.conn.OperationalError) and ('locked' in str(e) or 'busy' in str(e))
+
+    def _write(self, matches):
+        """
+        Writes matches in one transaction and returns the outcome of each, SAVE_OK or SAVE_DUPLICATE
+        """
+        # insert_match_vehicles adds the ids of new vehicles, which a rollback takes back
+        vehicles = dict(self.vehicles)
+        c = self.conn.cursor()
+        try:
+            with wotstats.stats.timer('save'):
+                hashes = [row[0] for row, vehicle_rows in matches]
+                stored = set()
+                for i in range(0, len(hashes), 500):
+                    part = hashes[i:i + 500]
+                    stored.update(str(h) for h, in c.execute(
+                        "select battlehash from matchdata where battlehash in ({})".format(', '.join('?' * len(part))), part))
+                outcomes = []
+                for h in hashes:
+                    outcomes.append(SAVE_DUPLICATE if h in stored else SAVE_OK)
+                    stored.add(h)
+
+                c.executemany(INSERT_MATCH_IGNORE, [row for row, vehicle_rows in matches])
+                insert_match_vehicles(c, [r for row, vehicle_rows in matches for r in vehicle_rows], vehicles)
+                self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            c.close()
+        self.vehicles = vehicles
+        return outcomes
+
+    def flush(self):
+        matches, tags = self.matches, self.tags
+        self.matches, self.tags = [], []
+        self.last_flush = time.time()
+        if not matches:
+            return
+
+        with wotstats.scope() as flush_stats:
+            try:
+                outcomes = self._write(matches)
+            except Exception as e:
+                if self._busy(e):
+                    log.warn("Could not save %s matches, will retry: %s", len(matches), e)
+                    outcomes = [SAVE_RETRY] * len(matches)
+                else:
+                    log.warn("Could not save %s matches, saving them one at a time: %s", len(matches), e)
+                    outcomes = self._write_each(matches)
+        self.save_time = flush_stats.times['save'] / len(matches)
+
+        inserted, duplicates = outcomes.count(SAVE_OK), outcomes.count(SAVE_DUPLICATE)
+        self.inserted += inserted
+        self.duplicates += duplicates
+        log.info("Saved %s matches, %s already stored", inserted, duplicates)
+
+        if self.on_saved:
+            for tag, outcome in zip(tags, outcomes):
+                self.on_saved(tag, outcome)
+
+    def _write_each(self, matches):
+        """
+        Writes matches one per transaction and returns the outcome of each. Once the database is busy
+        the remaining matches are left for later.
+        """
+        outcomes = []
+        for row, vehicle_rows in matches:
+            if outcomes and outcomes[-1] == SAVE_RETRY:
+                outcomes.append(SAVE_RETRY)
+                continue
+            try:
+                outcomes.extend(self._write([(row, vehicle_rows)]))
+            except Exception as e:
+                log.warn("Could not save match %s: %s", row[0], e)
+                outcomes.append(SAVE_RETRY if self._busy(e) else SAVE_FAILED)
+        return outcomes
+
+    def close(self):
+        self.flush()
+
+
+def parse_file(fname, vehicle_details=False):
+    """
+    Runs the parse, decrypt and decompress stages for one replay and returns the match data
+    to store, or None if the replay could not be parsed. With vehicle_details set, the match
+    data also holds the per-vehicle details of the battle results as 'vehicleDetails', in the
+    columns returned by details_columns. The stages are timed with wotstats.
+    """
     try:
-        c.execute(dml, tuple(data.values()))
-        settings.db_conn.commit()
-        c.close()
-        return True
-    except Exception as e:
-        log.warn(e)
-        return False
-
-
-def process_file(fname):
+        replay = ReplayReader(fname)
+    except EnvironmentError:
+        log.warn("Could not read file %s", fname)
+        return None
+
+    with replay:
+        return parse_replay(replay, vehicle_details)
+
+
+def parse_replay(replay, vehicle_details=False):
+    """
+    parse_file for an open ReplayReader: the cache key, the headers and the body all come
+    from its mapping of the file
+    """
+    fname = replay.fn
+    stats = wotstats.stats
     matchData = {
         'map': '',
         'gamemode': '',
@@ -91,19 +518,47 @@ def process_file(fname):
         'playerSide': '',
         'battleTier': 0,
         'hash': '',
+        'duplicate': False,
         'teams': {
             1: {'vehicles': [], 'kills': 0},
             2: {'vehicles': [], 'kills': 0},
         },
     }
 
-    try:
-        players, frags, details, boff = extract_headers(fname)
-    except TypeError:
-        return False
+    cached = None
+    if replay_cache:
+        with stats.timer('cache'):
+            cache_key = replay_cache.key(fname, replay.map)
+            cached = replay_cache.get(cache_key)
+
+    if cached:
+        log.debug("Using cached parse of %s", os.path.basename(fname))
+        players, frags, details = cached['players'], cached['frags'], cached['results']
+    else:
+        try:
+            with stats.timer('headers'):
+                players, frags, details, boff = replay.headers(header_only=True)
+        except TypeError:
+            return None
 
     if not players:
-        return False
+        return None
+
+    # Battles that are already stored are skipped before the body is decrypted
+    # In header only mode this is where the battle results are unpickled
+    try:
+        with stats.timer('headers'):
+            matchData['hash'] = get_match_hash(details, players['mapDisplayName'])
+    except safepickle.UnsafePickleError as e:
+        log.warn("Could not load battle results of %s: %s", os.path.basename(fname), e)
+        return None
+    except (KeyError, TypeError, AttributeError) as e:
+        log.warn("Malformed battle results in %s: %r", os.path.basename(fname), e)
+        return None
+    if matchData['hash'] in known_hashes:
+        log.debug("Match %s is already stored, skipping", matchData['hash'])
+        matchData['duplicate'] = True
+        return matchData
 
     # Process players fragment
     matchData['map'] = players['mapDisplayName']
@@ -122,28 +577,36 @@ def process_file(fname):
     else:
         matchData['outcome'] = 'draw'
 
-    matchData['hash'] = get_match_hash(details, matchData['map'])
+    kills = get_team_frags(players, frags)
+    matchData['teams'][1]['kills'] = kills[1]
+    matchData['teams'][2]['kills'] = kills[2]
 
-    frags = get_team_frags(players, frags)
-    matchData['teams'][1]['kills'] = frags[1]
-    matchData['teams'][2]['kills'] = frags[2]
-
-    decfile = decrypt_file(fname, boff)
-    outfile = decompress_file(decfile)
-    version, blevel, roster = extract_version_and_blevel(outfile)
-    os.unlink(decfile)
-    os.unlink(outfile)
+    if cached:
+        version, blevel = cached['version'], cached['blevel']
+    else:
+        with stats.timer('version'):
+            with replay.open_body(lazy=True) as body:
+                version, blevel, roster = extract_version_and_blevel(body)
+        if replay_cache and version is not None:
+            with stats.timer('cache'):
+                replay_cache.put(cache_key, players, frags, details, version, blevel, roster)
 
     matchData['battleTier'] = blevel
     matchData['replayVersion'] = version
     matchData['gametype'] = settings.GAME_TYPES[int(details['common']['bonusType'])]
+    if vehicle_details:
+        with stats.timer('details'):
+            matchData['vehicleDetails'] = details_columns(details['vehicles'])
 
-    log.info("Match hash {}, version {}".format(matchData['hash'], matchData['replayVersion']))
-    log.info("Match outcome: {}".format(matchData['outcome']))
+    log.debug("Match hash %s, version %s", matchData['hash'], matchData['replayVersion'])
+    log.debug("Match outcome: %s", matchData['outcome'])
+    return matchData
 
+
+def store_match_data(matchData):
     try:
         ret = save_match_data(matchData)
-        log.info("Save result: {}".format(ret))
+        log.info("Save result: %s", ret)
     except:
         log.warn(traceback.format_exc())
         return False
@@ -151,6 +614,62 @@ def process_file(fname):
     return True
 
 
+def process_file(fname):
+    stats = wotstats.stats
+    with stats.timer('classify'):
+        kind = classify_replay(fname)
+    if kind != REPLAY_OK:
+        log.warn("Replay %s is %s", os.path.basename(fname), kind)
+        stats.count('replays', kind)
+        return False
+
+    matchData = parse_file(fname)
+    if not matchData:
+        stats.count('replays', 'fail')
+        return False
+    if matchData['duplicate']:
+        stats.count('replays', 'duplicate')
+        return True
+    saved = store_match_data(matchData)
+    stats.count('replays', 'ok' if saved else 'fail')
+    return saved
+
+
+def parse_worker(fname, vehicle_details=False):
+    """
+    Process pool entry point: parses one replay and returns a tuple of (file name, match data or None,
+    worker pid, seconds spent, replay size, wotstats numbers, seconds per stage of this replay)
+    """
+    log.debug("Processing %s", os.path.basename(fname))
+    start = time.time()
+    size = 0
+    matchData = None
+    # Anything raised here would not reach the parent in watch mode, which waits for every replay it queued
+    with wotstats.scope() as replay_stats:
+        try:
+            size = os.path.getsize(fname)
+            # Pick up the matches the parent stored since this worker was forked, for the dedupe in parse_file
+            if start - known_refreshed >= settings.DB_FLUSH_INTERVAL:
+                try:
+                    refresh_known_hashes()
+                except Exception as e:
+                    log.debug("Could not refresh the known matches: %s", e)
+            matchData = parse_file(fname, vehicle_details)
+        except Exception:
+            log.warn(traceback.format_exc())
+    busy = time.time() - start
+    return fname, matchData, os.getpid(), busy, size, wotstats.stats.take(), dict(replay_stats.times)
+
+
+def init_worker():
+    """
+    Process pool initializer. Ctrl-C is left to the parent, which winds the workers down, so a replay
+    being parsed is not failed by a KeyboardInterrupt.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    wotstats.reset()
+
+
 def safe_rename(f, dstdir):
     bf = os.path.basename(f)
     nname = dstdir + "/" + bf
@@ -168,25 +687,335 @@ def ok_file(f):
     safe_rename(f, settings.DONE_DIR)
 
 
-def process_dir(dirname):
-    files = glob.glob(dirname + "/*.wotreplay")
-    for f in files:
-        bf = os.path.basename(f)
-        log.info("Processing {}".format(bf))
+def incomplete_file(f):
+    safe_rename(f, settings.INCOMPLETE_DIR)
+
+
+def log_worker_summary(workers, elapsed):
+    total = sum(w[0] for w in workers.values())
+    log.info("Processed %s replays in %.1fs (%.1f replays/s)", total, elapsed, total / elapsed if elapsed else 0)
+    for pid, (files, size, busy) in sorted(workers.items()):
+        log.info("Worker %s: %s replays, %.1f MB in %.1fs busy (%.1f replays/s, %.2f MB/s)",
+                 pid, files, size / 1048576.0, busy, files / busy if busy else 0, size / 1048576.0 / busy if busy else 0)
+
+
+class Ingest(object):
+    """
+    Stores and moves the replays handled by parse_worker: new matches go through a MatchWriter and
+    their replays are moved once committed, and exported with a ColumnarExporter when export is set
+    once they are stored. Replays of
+    stored matches go to DONE_DIR and failures to FAIL_DIR. Replays whose match could not be written
+    because the database was busy stay where they are and are added to 'deferred'. Replays are to
+    be passed to admit() before they are parsed. Keeps the statistics logged by summary().
+    """
+
+    def __init__(self, export=None):
+        global replay_cache
+        if settings.PARSE_CACHE:
+            replay_cache = ReplayCache(settings.CACHE_DIR, settings.CACHE_MAX_SIZE)
+        create_db()
+        refresh_known_hashes()
+        self.writer = MatchWriter(on_saved=self.saved)
+        self.exporter = ColumnarExporter(export) if export else None
+        self.worker = functools.partial(parse_worker, vehicle_details=bool(self.exporter))
+        self.stats = {}
+        self.classes = Counter()
+        self.deduped = 0
+        self.deferred = set()
+        self.start = time.time()
+
+    def admit(self, f):
+        """
+        Classifies replay f with classify_replay and returns True if it is to be parsed. Incomplete and
+        truncated replays are moved to INCOMPLETE_DIR and other unparseable files to FAIL_DIR instead.
+        """
         try:
-            if process_file(f):
-                ok_file(f)
+            with wotstats.scope() as replay_stats:
+                with replay_stats.timer('classify'):
+                    kind = classify_replay(f)
+        except (IOError, OSError) as e:
+            log.warn("Could not read %s: %s", f, e)
+            return False
+
+        self.classes[kind] += 1
+        if kind == REPLAY_OK:
+            return True
+
+        wotstats.stats.count('replays', kind)
+        replay_summary(f, kind, replay_stats.times)
+
+        try:
+            if kind in (REPLAY_INCOMPLETE, REPLAY_TRUNCATED):
+                incomplete_file(f)
             else:
                 fail_file(f)
-        except:
+        except OSError:
+            log.warn(traceback.format_exc())
+        return False
+
+    def handle(self, result):
+        f, matchData, pid, busy, size, numbers, timings = result
+        wotstats.stats.merge(numbers)
+        timings = dict(timings, total=busy)
+        try:
+            if not matchData:
+                self.fail(f)
+                self.classes['failed'] += 1
+                wotstats.stats.count('replays', 'fail')
+                replay_summary(f, 'fail', timings, size=size)
+            elif matchData['duplicate'] or matchData['hash'] in known_hashes:
+                ok_file(f)
+                self.deduped += 1
+                wotstats.stats.count('replays', 'duplicate')
+                replay_summary(f, 'duplicate', timings, size=size)
+            else:
+                known_hashes.add(matchData['hash'])
+                self.writer.add(matchData, (f, matchData, size, timings))
+        except Exception:
             log.warn(traceback.format_exc())
+            self.fail(f)
+            replay_summary(f, 'fail', timings, size=size)
+
+        w = self.stats.setdefault(pid, [0, 0, 0.0])
+        w[0] += 1
+        w[1] += size
+        w[2] += busy
+
+    def lost(self, f, error):
+        """
+        Fails replay f, whose worker raised error instead of returning a result
+        """
+        log.warn("Could not parse %s: %s", f, error)
+        self.fail(f)
+        self.classes['failed'] += 1
+        wotstats.stats.count('replays', 'fail')
+        replay_summary(f, 'fail', {})
+
+    def fail(self, f):
+        """
+        Moves replay f to FAIL_DIR, unless it is gone already
+        """
+        try:
+            fail_file(f)
+        except OSError as e:
+            log.warn("Could not move %s: %s", f, e)
+
+    def saved(self, tag, outcome):
+        """
+        MatchWriter.on_saved callback, moves the replay once its match is written
+        """
+        f, matchData, size, timings = tag
+        replay_summary(f, outcome, dict(timings, save=self.writer.save_time), size=size)
+        if outcome not in (SAVE_OK, SAVE_DUPLICATE):
+            known_hashes.discard(matchData['hash'])
+        if outcome == SAVE_RETRY:
+            self.deferred.add(f)
+            return
+
+        wotstats.stats.count('replays', outcome)
+        if outcome == SAVE_DUPLICATE:
+            ok_file(f)
+        elif outcome == SAVE_OK:
+            if self.exporter:
+                try:
+                    self.exporter.add(matchData)
+                except Exception:
+                    # The match is stored either way
+                    log.warn(traceback.format_exc())
+            ok_file(f)
+        else:
             fail_file(f)
 
+    def poll(self):
+        """
+        Writes the matches and exports that have been pending longer than their flush intervals
+        """
+        self.writer.poll()
+        if self.exporter:
+            self.exporter.poll()
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1 and os.path.exists(sys.argv[1]):
-        if os.path.isdir(sys.argv[1]):
-            process_dir(sys.argv[1])
-        elif os.path.isfile(sys.argv[1]):
-            process_file(sys.argv[1])
+    def close(self):
+        try:
+            self.writer.close()
+        finally:
+            if self.exporter:
+                self.exporter.close()
+
+    def summary(self):
+        log_worker_summary(self.stats, time.time() - self.start)
+        log.info("Replays by class: %s", ", ".join("{} {}".format(k, n) for k, n in sorted(self.classes.items())))
+        log.info("Skipped %s replays of already stored matches", self.deduped)
+        report_stats()
+
+
+def report_stats():
+    """
+    Logs the wotstats summary and writes it to settings.STATS_FILE, if instrumentation is on
+    """
+    stats = wotstats.stats
+    if not stats.enabled:
+        return
+    for line in stats.summary():
+        log.info("%s", line)
+    if settings.STATS_FILE:
+        stats.write_prometheus(settings.STATS_FILE)
+
+
+def process_dir(dirname, workers=1, export=None):
+    """
+    Processes every replay in dirname. With more than one worker, the parse, decrypt and decompress
+    stages run in a process pool while this process does all the database writes and file moves.
+    Matches are written in batches, and each replay is moved once its batch has been committed.
+    New matches are also exported to columnar files under export, if given.
+    """
+    ingest = Ingest(export)
+    files = [f for f in glob.glob(dirname + "/*.wotreplay") if ingest.admit(f)]
+
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, init_worker)
+        results = pool.imap_unordered(ingest.worker, files)
+    else:
+        results = itertools.imap(ingest.worker, files)
+
+    try:
+        for result in results:
+            ingest.handle(result)
+    except KeyboardInterrupt:
+        # The replays not handled yet stay in dirname
+        log.info("Interrupted, stopping the workers")
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        ingest.close()
+        if pool:
+            pool.close()
+            pool.join()
+
+    ingest.summary()
+
+
+def reap_failed(ingest, pending):
+    """
+    Fails the replays in pending (replay -> AsyncResult) whose task raised, e.g. because its result
+    could not be pickled. apply_async only calls back on success, so these never reach the results.
+    """
+    for f, result in pending.items():
+        if result.ready() and not result.successful():
+            del pending[f]
+            try:
+                result.get()
+            except Exception as e:
+                ingest.lost(f, e)
+
+
+def watch_dir(dirname, workers=1, export=None, poll_interval=None, settle_time=None, max_pending=None,
+              on_start=None):
+    """
+    Daemon mode of process_dir: polls dirname every poll_interval seconds and hands each replay to the
+    worker processes once its size and mtime have not changed for settle_time seconds, so files still
+    being uploaded are left alone. At most max_pending replays (WATCH_PENDING_PER_WORKER per worker by
+    default) are queued at a time, and the rest wait in dirname. on_start is called once the worker
+    processes are running. Runs until interrupted or terminated.
+    """
+    poll_interval = settings.WATCH_POLL_INTERVAL if poll_interval is None else poll_interval
+    settle_time = settings.WATCH_SETTLE_TIME if settle_time is None else settle_time
+    workers = max(workers, 1)
+    max_pending = max_pending or workers * settings.WATCH_PENDING_PER_WORKER
+
+    ingest = Ingest(export)
+    pool = multiprocessing.Pool(workers, init_worker)
+    # Let the workers finish their replays on SIGTERM while this process winds down
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    done = Queue.Queue()
+    stats_written = time.time()
+    seen = {}  # replay -> ((size, mtime), time it was first seen with them)
+    pending = {}  # replays queued to the workers -> their AsyncResult
+    submitted = set()  # replays queued or handled, until they are moved out of dirname
+    log.info("Watching %s with %s workers", dirname, workers)
+
+    try:
+        if on_start:
+            on_start()
+        while True:
+            now = time.time()
+            files = glob.glob(dirname + "/*.wotreplay")
+            for f in files:
+                if len(pending) >= max_pending:
+                    break
+                if f in submitted:
+                    continue
+                try:
+                    st = os.stat(f)
+                except OSError:
+                    continue
+                sig = (st.st_size, st.st_mtime)
+                if f not in seen or seen[f][0] != sig:
+                    seen[f] = (sig, now)
+                    continue
+                if now - seen[f][1] < settle_time:
+                    continue
+
+                del seen[f]
+                submitted.add(f)
+                if not ingest.admit(f):
+                    continue
+                pending[f] = pool.apply_async(ingest.worker, (f, ), callback=done.put)
+
+            files = set(files)
+            submitted &= files
+            for f in seen.keys():
+                if f not in files:
+                    del seen[f]
+
+            deadline = now + poll_interval
+            while True:
+                try:
+                    result = done.get(timeout=max(deadline - time.time(), 0))
+                except Queue.Empty:
+                    break
+                pending.pop(result[0], None)
+                ingest.handle(result)
+            reap_failed(ingest, pending)
+            ingest.poll()
+            # Replays left behind by a busy database go through the settle time again
+            submitted -= ingest.deferred
+            ingest.deferred.clear()
+            if wotstats.stats.enabled and settings.STATS_FILE and time.time() - stats_written >= settings.STATS_WRITE_INTERVAL:
+                wotstats.stats.write_prometheus(settings.STATS_FILE)
+                stats_written = time.time()
+    except (KeyboardInterrupt, SystemExit):
+        log.info("Stopping, waiting for %s replays in progress", len(pending))
+    finally:
+        pool.close()
+        pool.join()
+        while not done.empty():
+            ingest.handle(done.get())
+        reap_failed(ingest, pending)
+        ingest.close()
+        ingest.summary()
 
+
+if __name__ == "__main__":
+    settings.configure_logging()
+    parser = argparse.ArgumentParser(description="Parse replays and store the match data")
+    parser.add_argument("path", nargs="?", default=settings.NEW_DIR, help="replay file or directory of replays")
+    parser.add_argument("--workers", type=int, default=1, help="number of parser processes for directories")
+    parser.add_argument("--export", metavar="DIR", help="also export new matches to columnar files in DIR")
+    parser.add_argument("--watch", action="store_true", help="keep watching the directory for new replays")
+    parser.add_argument("--stats", action="store_true", help="time the parse stages and count replays and bytes")
+    parser.add_argument("--stats-file", metavar="FILE", help="write the --stats numbers to FILE in Prometheus format")
+    args = parser.parse_args()
+    if args.stats_file:
+        settings.STATS_FILE = args.stats_file
+    if settings.STATS or args.stats or args.stats_file:
+        wotstats.enable()
+
+    if args.watch:
+        watch_dir(args.path, args.workers, args.export)
+    elif os.path.isdir(args.path):
+        process_dir(args.path, args.workers, args.export)
+    elif os.path.isfile(args.path):
+        process_file(args.path)
+        report_stats()